@@ -0,0 +1,78 @@
+import os
+import copy
+import json
+
+
+def rail_lines_path(image_path):
+    return image_path.replace(".png", "_rail_lines.json")
+
+
+def write_json_atomic(path, data):
+    # Write to a temporary file and rename it over the target, so a crash never leaves a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def read_rail_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+class AnnotationStore:
+    # Rail lines of every opened image held in memory, keyed by their JSON path. Changes are recorded
+    # with undo/redo history and marked dirty until flush writes them back.
+    def __init__(self, history_size=100):
+        self.history_size = history_size
+        self.rail_lines = {}
+        self.undo_stacks = {}
+        self.redo_stacks = {}
+        self.dirty = set()
+
+    def get(self, path):
+        # A copy, so callers can edit it freely before passing it to set
+        if path not in self.rail_lines:
+            self.rail_lines[path] = read_rail_lines(path)
+        return copy.deepcopy(self.rail_lines[path])
+
+    def preload(self, path, rail_lines):
+        # Rail lines read elsewhere, e.g. by a prefetch thread; never replaces lines already in memory
+        self.rail_lines.setdefault(path, rail_lines)
+
+    def set(self, path, rail_lines):
+        # Coordinates are kept as lists, as they come back from JSON, so they can be edited in place
+        for rail_line in rail_lines:
+            rail_line["coordinates"] = list(rail_line["coordinates"])
+        if path not in self.rail_lines:
+            self.rail_lines[path] = read_rail_lines(path)
+        undo_stack = self.undo_stacks.setdefault(path, [])
+        undo_stack.append(self.rail_lines[path])
+        del undo_stack[:-self.history_size]
+        self.redo_stacks.pop(path, None)
+        self.rail_lines[path] = rail_lines
+        self.dirty.add(path)
+
+    def undo(self, path):
+        return self.step(path, self.undo_stacks, self.redo_stacks)
+
+    def redo(self, path):
+        return self.step(path, self.redo_stacks, self.undo_stacks)
+
+    def step(self, path, from_stacks, to_stacks):
+        if not from_stacks.get(path):
+            return False
+        to_stacks.setdefault(path, []).append(self.rail_lines[path])
+        self.rail_lines[path] = from_stacks[path].pop()
+        self.dirty.add(path)
+        return True
+
+    def flush(self):
+        for path in sorted(self.dirty):
+            write_json_atomic(path, self.rail_lines[path])
+        self.dirty.clear()
@@ -0,0 +1,587 @@
+import argparse
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import laspy
+import numpy as np
+import cv2
+import generate_data
+from generate_data import grid_edges, group_points_by_tile, non_empty_tiles, save_lidar_grid, tile_grid
+from rasterize import REDUCERS, rasterize_tiles
+
+
+def make_synthetic_las(las_file_name, n_points, extent=(100.0, 100.0), seed=0):
+    rng = np.random.default_rng(seed)
+    las_data = laspy.create(point_format=3, file_version='1.2')
+    las_data.header.offsets = [0.0, 0.0, 0.0]
+    las_data.header.scales = [0.001, 0.001, 0.001]
+    las_data.x = rng.uniform(0, extent[0], n_points)
+    las_data.y = rng.uniform(0, extent[1], n_points)
+    las_data.z = rng.uniform(-1, 5, n_points)
+    las_data.intensity = rng.integers(0, 2 ** 16, n_points, dtype=np.uint16)
+    las_data.write(las_file_name)
+    return las_data
+
+
+RAIL_GAUGE = 1.435
+
+
+def rail_centrelines(length, width, spacing=0.05):
+    # A straight track and a curved one along x, as (n, 2) arrays of points on their centrelines
+    x = np.arange(0, length + spacing, spacing)
+    straight = np.stack([x, np.full_like(x, width * 0.3)], axis=1)
+    curve = width * 0.3 * ((x - length / 2) / (length / 2)) ** 2
+    curved = np.stack([x, width * 0.6 + curve], axis=1)
+    return [straight, curved]
+
+
+def rail_polylines(centreline):
+    # Both rails of a track, offset half the gauge to either side of its centreline
+    direction = np.gradient(centreline, axis=0)
+    normal = np.stack([-direction[:, 1], direction[:, 0]], axis=1)
+    normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+    return [centreline + normal * RAIL_GAUGE / 2, centreline - normal * RAIL_GAUGE / 2]
+
+
+def make_rail_las(las_file_name, n_points, length=40.96, width=20.48, rail_fraction=0.1, seed=0):
+    # Ground with a little noise plus rail heads 17 cm above it on a straight and a curved track.
+    # Returns the rails as (n, 2) polylines in LAS coordinates.
+    rng = np.random.default_rng(seed)
+    rails = [rail for centreline in rail_centrelines(length, width) for rail in rail_polylines(centreline)]
+    n_rail = int(n_points * rail_fraction)
+    n_ground = n_points - n_rail
+
+    # Rail points are spread evenly over the rails, 7 cm wide
+    rail_points = np.concatenate(rails)
+    picks = rail_points[rng.integers(0, len(rail_points), n_rail)]
+    picks += rng.normal(0, 0.02, picks.shape)
+    x = np.concatenate([rng.uniform(0, length, n_ground), np.clip(picks[:, 0], 0, length)])
+    y = np.concatenate([rng.uniform(0, width, n_ground), np.clip(picks[:, 1], 0, width)])
+    z = np.concatenate([rng.normal(0, 0.03, n_ground), 0.17 + rng.normal(0, 0.005, n_rail)])
+
+    las_data = laspy.create(point_format=3, file_version='1.2')
+    las_data.header.offsets = [0.0, 0.0, 0.0]
+    las_data.header.scales = [0.001, 0.001, 0.001]
+    las_data.x, las_data.y, las_data.z = x, y, z
+    las_data.intensity = rng.integers(0, 2 ** 16, n_points, dtype=np.uint16)
+    las_data.write(las_file_name)
+    return rails
+
+
+def rail_annotations(rails, tiles, x_edges, y_edges, img_size, resolution, step=50):
+    # Rail lines of every tile in pixel coordinates, from segments of the rail polylines that lie inside it
+    annotations = {}
+    for x_idx, y_idx in tiles:
+        rail_lines = []
+        for rail in rails:
+            pixels = np.round((rail[::step] - (x_edges[x_idx], y_edges[y_idx])) / resolution).astype(int)
+            inside = ((pixels[:, 0] >= 0) & (pixels[:, 0] < img_size[0]) &
+                      (pixels[:, 1] >= 0) & (pixels[:, 1] < img_size[1]))
+            for start in np.flatnonzero(inside[:-1] & inside[1:]):
+                rail_lines.append({"id": len(rail_lines), "type": "rail", "color": [0, 0, 255, 80],
+                                   "coordinates": [int(value) for value in pixels[start:start + 2].ravel()]})
+        annotations[(x_idx, y_idx)] = rail_lines
+    return annotations
+
+
+def timed(func, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def tile_with_masks(x_data, y_data, x_edges, y_edges):
+    # Previous approach: one boolean mask over the whole cloud per tile
+    n_points = 0
+    for y_idx in range(len(y_edges) - 1):
+        for x_idx in range(len(x_edges) - 1):
+            mask = (x_data >= x_edges[x_idx]) & (x_data < x_edges[x_idx + 1]) & (
+                y_data >= y_edges[y_idx]) & (y_data < y_edges[y_idx + 1])
+            if np.any(mask):
+                n_points += len(x_data[mask])
+    return n_points
+
+
+def tile_with_sort(x_data, y_data, x_edges, y_edges):
+    order, offsets = group_points_by_tile(x_data, y_data, x_edges, y_edges)
+    n_points = 0
+    for tile_id in range(len(offsets) - 1):
+        indices = order[offsets[tile_id]:offsets[tile_id + 1]]
+        if len(indices):
+            n_points += len(x_data[indices])
+    return n_points
+
+
+def bench_tiling(args):
+    rng = np.random.default_rng(0)
+    x_data = rng.uniform(0, args.extent, args.points)
+    y_data = rng.uniform(0, args.extent, args.points)
+
+    print(f'{"tiles":>8} {"mask (s)":>10} {"sort (s)":>10} {"speedup":>8}')
+    for grids in args.grids:
+        tile_size = args.extent / grids
+        x_edges = grid_edges(0.0, grids, tile_size, 1.0)
+        y_edges = grid_edges(0.0, grids, tile_size, 1.0)
+        mask_time = timed(lambda: tile_with_masks(
+            x_data, y_data, x_edges, y_edges), repeat=1)
+        sort_time = timed(lambda: tile_with_sort(
+            x_data, y_data, x_edges, y_edges))
+        print(f'{grids * grids:>8} {mask_time:>10.3f} {sort_time:>10.3f} {mask_time / sort_time:>7.1f}x')
+
+
+def save_lidar_grid_per_dimension(las_data, indices, las_file_name):
+    # Previous approach: copy every dimension separately into a default header
+    las_out = laspy.create()
+    for dim_name in las_data.point_format.dimension_names:
+        setattr(las_out, dim_name, getattr(las_data, dim_name)[indices])
+    las_out.write(las_file_name)
+
+
+def bench_las_write(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        las_data = make_synthetic_las(os.path.join(
+            work_dir, 'source.las'), args.points)
+        tiles = np.array_split(np.arange(args.points), args.tiles)
+        output_path = os.path.join(work_dir, 'tile.las')
+
+        def write_all(writer, **kwargs):
+            for indices in tiles:
+                writer(las_data, indices, output_path, **kwargs)
+
+        per_dimension = timed(lambda: write_all(save_lidar_grid_per_dimension))
+        record_slice = timed(lambda: write_all(save_lidar_grid))
+        print(f'per-dimension copy: {per_dimension / args.tiles * 1000:.2f} ms/tile')
+        print(f'record slice:       {record_slice / args.tiles * 1000:.2f} ms/tile '
+              f'({per_dimension / record_slice:.1f}x)')
+        if args.laz:
+            laz = timed(lambda: write_all(save_lidar_grid, compress=True))
+            print(f'record slice (LAZ): {laz / args.tiles * 1000:.2f} ms/tile')
+
+
+def rasterize_with_histogram2d(x_data, y_data, z_data, tiles, x_edges, y_edges, img_size, z_min, z_max):
+    # Previous approach: a weighted histogram per tile, which sums Z per pixel
+    images = []
+    for x_idx, y_idx, start, stop in tiles:
+        hist, _, _ = np.histogram2d(y_data[start:stop], x_data[start:stop], bins=(img_size[1], img_size[0]),
+                                    range=[[y_edges[y_idx], y_edges[y_idx + 1]], [x_edges[x_idx], x_edges[x_idx + 1]]],
+                                    weights=z_data[start:stop])
+        images.append((((hist - z_min) / (z_max - z_min)) * 255).astype(np.uint8))
+    return images
+
+
+def bench_raster(args):
+    rng = np.random.default_rng(0)
+    x_data = rng.uniform(0, args.extent, args.points)
+    y_data = rng.uniform(0, args.extent, args.points)
+    z_data = rng.uniform(-1, 5, args.points)
+    img_size = (args.img_size, args.img_size)
+    resolution = args.extent / (args.grids * args.img_size)
+    x_edges = grid_edges(0.0, args.grids, img_size[0], resolution)
+    y_edges = grid_edges(0.0, args.grids, img_size[1], resolution)
+
+    order, offsets = group_points_by_tile(x_data, y_data, x_edges, y_edges)
+    x_data, y_data, z_data = x_data[order], y_data[order], z_data[order]
+    tiles = non_empty_tiles(offsets, args.grids)
+
+    histogram = timed(lambda: rasterize_with_histogram2d(
+        x_data, y_data, z_data, tiles, x_edges, y_edges, img_size, -5, 45))
+    print(f'{"histogram2d (sum)":>18}: {histogram:.3f} s')
+    for reducer in REDUCERS:
+        scatter = timed(lambda: rasterize_tiles(
+            x_data, y_data, z_data, tiles, x_edges, y_edges, img_size, -5, 45, reducer))
+        print(f'{reducer:>18}: {scatter:.3f} s ({histogram / scatter:.1f}x)')
+
+
+def make_synthetic_dataset(root, n_tiles, img_size=1024, seed=0):
+    # Tiles in the per-tile directory layout: noise with a few brighter random lines, and the lines as masks
+    rng = np.random.default_rng(seed)
+    for tile in range(n_tiles):
+        grid_name = f'synthetic_{tile}_0'
+        grid_dir = os.path.join(root, 'synthetic', grid_name)
+        os.makedirs(grid_dir, exist_ok=True)
+        image = rng.integers(0, 256, (img_size, img_size), dtype=np.uint8)
+        mask = np.zeros((img_size, img_size), dtype=np.uint8)
+        for _ in range(3):
+            x1, y1, x2, y2 = (int(value) for value in rng.integers(0, img_size, 4))
+            cv2.line(mask, (x1, y1), (x2, y2), 255, 10)
+        image[mask > 0] = np.maximum(image[mask > 0], 192)
+        cv2.imwrite(os.path.join(grid_dir, f'{grid_name}_image.png'), image)
+        cv2.imwrite(os.path.join(
+            grid_dir, f'{grid_name}_image_segmentation.png'), mask)
+
+
+def bench_dataset(args):
+    import torch
+    from torch.utils.data import DataLoader
+    from torchvision import transforms
+    from train import RailDataset
+
+    transform = transforms.Compose(
+        [transforms.Resize((256, 256)), transforms.ToTensor()])
+
+    def epoch(dataset):
+        loader = DataLoader(dataset, batch_size=4, shuffle=True, num_workers=args.workers)
+        for inputs, targets in loader:
+            pass
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        root = os.path.join(work_dir, 'data')
+        make_synthetic_dataset(root, args.tiles)
+        torch.manual_seed(0)
+
+        png = timed(lambda: epoch(RailDataset(root, transform)), repeat=args.epochs)
+        print(f'{"decode per access":>18}: {args.tiles / png:8.1f} samples/s')
+        cache_dir = os.path.join(work_dir, 'cache')
+        build = timed(lambda: RailDataset(root, transform, cache_dir), repeat=1)
+        print(f'{"cache build":>18}: {build:8.2f} s (once per transform and file set)')
+        dataset = RailDataset(root, transform, cache_dir)
+        cached = timed(lambda: epoch(dataset), repeat=args.epochs)
+        print(f'{"memory-mapped":>18}: {args.tiles / cached:8.1f} samples/s ({png / cached:.1f}x)')
+
+
+def legacy_rail_net():
+    # Previous model: two convolutions and a dense head giving one scalar per 256x256 tile
+    import torch.nn as nn
+
+    return nn.Sequential(
+        nn.Conv2d(1, 16, kernel_size=3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+        nn.Conv2d(16, 32, kernel_size=3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+        nn.Flatten(), nn.Linear(32 * 64 * 64, 128), nn.ReLU(), nn.Linear(128, 1))
+
+
+def count_flops(model, inputs):
+    # Multiply-adds of convolutions and linear layers counted as two FLOPs, per input sample
+    import torch.nn as nn
+
+    flops = []
+
+    def hook(module, module_inputs, output):
+        if isinstance(module, nn.Conv2d):
+            kernel = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+            flops.append(2 * output[0].numel() * kernel)
+        elif isinstance(module, nn.ConvTranspose2d):
+            kernel = module.out_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+            flops.append(2 * module_inputs[0][0].numel() * kernel)
+        elif isinstance(module, nn.Linear):
+            flops.append(2 * module.in_features * module.out_features)
+
+    handles = [module.register_forward_hook(hook) for module in model.modules()]
+    model(inputs)
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+
+def bench_model(args):
+    import torch
+    from train import RailNet
+
+    torch.set_num_threads(args.threads)
+    print(f'{"model":>10} {"input":>10} {"params":>10} {"GFLOPs":>8} {"ms/tile":>8}')
+    with torch.inference_mode():
+        for name, model, size in [('legacy', legacy_rail_net(), 256), ('RailNet', RailNet(), 256),
+                                  ('RailNet', RailNet(), 1024)]:
+            model.eval()
+            inputs = torch.rand(args.batch_size, 1, size, size)
+            params = sum(parameter.numel() for parameter in model.parameters())
+            gflops = count_flops(model, inputs[:1]) / 1e9
+            model(inputs)
+            elapsed = timed(lambda: model(inputs), repeat=args.repeat)
+            print(f'{name:>10} {f"{size}x{size}":>10} {params:>10,} {gflops:>8.2f} '
+                  f'{elapsed / args.batch_size * 1000:>8.1f}')
+
+
+def bench_ddp(args):
+    # train.py under torchrun with 1, 2, 4... processes on one machine. Each run gets the same total
+    # number of threads, split between its processes, and the last epoch is measured.
+    train_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+    with tempfile.TemporaryDirectory() as work_dir:
+        make_synthetic_dataset(os.path.join(work_dir, 'data'), args.tiles)
+        print(f'{"processes":>10} {"threads":>8} {"samples/s":>10} {"speedup":>8}')
+        baseline = None
+        for processes in args.processes:
+            threads = max(1, args.threads // processes)
+            output = subprocess.run(
+                [sys.executable, '-m', 'torch.distributed.run', '--standalone', f'--nproc-per-node={processes}',
+                 train_script, '--epochs', str(args.epochs), '--batch-size', str(args.batch_size),
+                 '--workers', '0', '--threads', str(threads), '--cache-dir', 'cache'],
+                cwd=work_dir, capture_output=True, text=True, check=True).stdout
+            samples_per_second = float(re.findall(r'([\d.]+) samples/s', output)[-1])
+            baseline = baseline or samples_per_second
+            print(f'{processes:>10} {threads:>8} {samples_per_second:>10.1f} '
+                  f'{samples_per_second / baseline:>7.2f}x')
+
+
+def fit_briefly(model, inputs, targets, steps):
+    # A few optimizer steps, so the model predicts some rail pixels for the drift comparison. Rail pixels
+    # are weighted up as they are only a few percent of each tile.
+    import torch
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+    pos_weight = (1 - targets.mean()) / targets.mean()
+    model.train()
+    for step in range(steps):
+        batch = torch.randint(0, len(inputs), (4,))
+        loss = torch.nn.functional.binary_cross_entropy_with_logits(model(inputs[batch]), targets[batch],
+                                                                    pos_weight=pos_weight)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return model.eval()
+
+
+# Seconds from importing the loader to the first prediction, with torch already imported
+COLD_START = '''
+import sys, time, torch
+start = time.perf_counter()
+from model_loader import load_model
+model = load_model(sys.argv[1])
+with torch.inference_mode():
+    model(torch.rand(1, 1, 256, 256))
+print(time.perf_counter() - start)
+'''
+
+
+def bench_export(args):
+    # Cold start, latency and drift against the fp32 model of the state dict, TorchScript and int8
+    # TorchScript. Without --model a RailNet is fitted briefly on synthetic tiles.
+    import torch
+    from export import calibration_inputs, export_model, quantize
+    from model_loader import load_model
+    from train import RailNet
+
+    torch.set_num_threads(args.threads)
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as work_dir:
+        root = os.path.join(work_dir, 'data')
+        make_synthetic_dataset(root, args.tiles)
+        inputs = torch.cat(calibration_inputs(root, args.tiles))
+        masks = [cv2.imread(os.path.join(root, 'synthetic', f'synthetic_{tile}_0',
+                                         f'synthetic_{tile}_0_image_segmentation.png'), cv2.IMREAD_GRAYSCALE)
+                 for tile in range(args.tiles)]
+        targets = torch.from_numpy(np.stack([cv2.resize(mask, inputs.shape[:-3:-1], interpolation=cv2.INTER_AREA)
+                                             for mask in masks]) > 127).float()[:, None]
+
+        model = RailNet()
+        if args.model:
+            model.load_state_dict(torch.load(args.model, map_location='cpu'))
+        else:
+            torch.manual_seed(0)
+            model = fit_briefly(model, inputs, targets, args.steps)
+        paths = {'state dict': os.path.join(work_dir, 'model.pth'),
+                 'torchscript': os.path.join(work_dir, 'model.pt'),
+                 'int8': os.path.join(work_dir, 'model_int8.pt')}
+        torch.save(model.state_dict(), paths['state dict'])
+        export_model(model, paths['torchscript'])
+        export_model(quantize(load_model(paths['state dict']), list(inputs[:, None])), paths['int8'])
+
+        with torch.inference_mode():
+            reference = torch.sigmoid(model(inputs))
+        print(f'{"model":>12} {"size MB":>8} {"cold s":>7} {"ms/tile":>8} {"max drift":>10} {"mask IoU":>9}')
+        for name, path in paths.items():
+            cold_start = min(float(subprocess.run([sys.executable, '-c', COLD_START, path], cwd=package_dir,
+                                                  capture_output=True, text=True, check=True).stdout)
+                             for _ in range(args.repeat))
+            loaded = load_model(path)
+            with torch.inference_mode():
+                loaded(inputs[:args.batch_size])
+                elapsed = timed(lambda: loaded(inputs[:args.batch_size]), repeat=args.repeat)
+                probabilities = torch.sigmoid(loaded(inputs))
+            drift = (probabilities - reference).abs().max().item()
+            masks, reference_masks = probabilities > 0.5, reference > 0.5
+            union = (masks | reference_masks).sum().item()
+            iou = (masks & reference_masks).sum().item() / union if union else 1.0
+            print(f'{name:>12} {os.path.getsize(path) / 2 ** 20:>8.2f} {cold_start:>7.2f} '
+                  f'{elapsed / args.batch_size * 1000:>8.1f} {drift:>10.4f} {iou:>9.4f}')
+
+
+def bench_suite(args):
+    # Every stage of the pipeline on a synthetic LAS file with straight and curved rails, from tiling to
+    # vectorized predictions. Each stage runs once and its time and throughput go into the results.
+    import torch
+    from annotations import rail_lines_path, write_json_atomic
+    from infer import dataset_tiles, predict_source
+    from masks import build_masks
+    from rasterize import rasterize_tiles
+    from tile_store import tile_image_path
+    from torchvision import transforms
+    from torch.utils.data import DataLoader
+    from train import RailDataset, RailNet
+    from vectorize import vectorize_predictions
+
+    torch.set_num_threads(args.threads)
+    img_size, resolution, z_min, z_max = (1024, 1024), 0.01, -5, 45
+    results = {'parameters': vars(args).copy(),
+               'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                               'cpu_count': os.cpu_count(), 'numpy': np.__version__,
+                               'torch': torch.__version__, 'laspy': laspy.__version__},
+               'stages': {}}
+    del results['parameters']['func']
+    print(f'{"stage":>14} {"seconds":>9} {"items":>10} {"rate":>18}')
+
+    def stage(name, func, items, unit):
+        start = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - start
+        results['stages'][name] = {'seconds': seconds, 'items': items,
+                                   'unit': unit, 'per_second': items / seconds}
+        print(f'{name:>14} {seconds:>9.3f} {items:>10} {items / seconds:>10.1f} {unit}/s')
+        return value
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        root = os.path.join(work_dir, 'data')
+        os.makedirs(root)
+        las_path = os.path.join(root, 'synthetic_rails.las')
+        rails = stage('synthesize', lambda: make_rail_las(las_path, args.points, args.length, args.width),
+                      args.points, 'points')
+
+        # The stages of generate_data one by one
+        las_data = laspy.read(las_path)
+        x_data, y_data, z_data = np.array(las_data.x), np.array(las_data.y), np.array(las_data.z)
+        x_edges, y_edges = tile_grid(x_data.min(), x_data.max(), y_data.min(), y_data.max(), img_size,
+                                     resolution)
+        order, offsets = stage('tiling', lambda: group_points_by_tile(x_data, y_data, x_edges, y_edges),
+                               args.points, 'points')
+        tiles = non_empty_tiles(offsets, len(x_edges) - 1)
+        order = order[:offsets[-1]]
+        stage('rasterize', lambda: rasterize_tiles(x_data[order], y_data[order], z_data[order], tiles, x_edges,
+                                                   y_edges, img_size, z_min, z_max), len(tiles), 'tiles')
+        tile_las_path = os.path.join(work_dir, 'tile.las')
+        stage('las-write', lambda: [save_lidar_grid(las_data, order[start:stop], tile_las_path)
+                                    for _, _, start, stop in tiles], len(tiles), 'tiles')
+
+        # End to end generation, which globs data/ in the working directory
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            stage('generate', lambda: generate_data.generate_unlabelled_data(
+                workers=args.workers, progress=lambda *progress: None), len(tiles), 'tiles')
+        finally:
+            os.chdir(cwd)
+
+        # Rail lines drawn from the known geometry, then masks as the labelling tool builds them
+        source = os.path.splitext(os.path.basename(las_path))[0]
+        annotations = rail_annotations(rails, [tile[:2] for tile in tiles], x_edges, y_edges, img_size,
+                                       resolution)
+        image_paths = []
+        for (x_idx, y_idx), rail_lines in annotations.items():
+            image_path = tile_image_path(root, source, x_idx, y_idx)
+            write_json_atomic(rail_lines_path(image_path), rail_lines)
+            image_paths.append(image_path)
+        stage('masks', lambda: build_masks(image_paths, root, workers=args.workers), len(image_paths), 'tiles')
+
+        transform = transforms.Compose([transforms.Resize((256, 256)), transforms.ToTensor()])
+
+        def epoch(dataset):
+            for inputs, targets in DataLoader(dataset, batch_size=4, shuffle=True):
+                pass
+
+        stage('dataset', lambda: epoch(RailDataset(root, transform)), len(image_paths), 'samples')
+        cache_dir = os.path.join(work_dir, 'cache')
+        stage('dataset-cache', lambda: RailDataset(root, transform, cache_dir), len(image_paths), 'samples')
+        cached = RailDataset(root, transform, cache_dir)
+        stage('dataset-mmap', lambda: epoch(cached), len(image_paths), 'samples')
+
+        # Throughput only: an untrained model costs the same as a trained one
+        model = RailNet().eval()
+        stage('inference', lambda: predict_source(model, dataset_tiles(root)[source], batch_size=args.batch_size),
+              len(image_paths), 'tiles')
+        stage('vectorize', lambda: vectorize_predictions(image_paths, workers=args.workers, overwrite=True),
+              len(image_paths), 'tiles')
+
+    if args.output:
+        write_json_atomic(args.output, results)
+        print(f'Results written to {args.output}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rail Detector benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    tiling_parser = subparsers.add_parser(
+        'tiling', help='per-tile masks vs single-pass tile binning')
+    tiling_parser.add_argument('--points', type=int, default=2_000_000)
+    tiling_parser.add_argument('--extent', type=float, default=100.0)
+    tiling_parser.add_argument('--grids', type=int, nargs='+',
+                               default=[2, 4, 8, 16, 32])
+    tiling_parser.set_defaults(func=bench_tiling)
+
+    las_write_parser = subparsers.add_parser(
+        'las-write', help='per-dimension vs record-slice tile LAS writing')
+    las_write_parser.add_argument('--points', type=int, default=1_000_000)
+    las_write_parser.add_argument('--tiles', type=int, default=64)
+    las_write_parser.add_argument('--laz', action='store_true')
+    las_write_parser.set_defaults(func=bench_las_write)
+
+    raster_parser = subparsers.add_parser(
+        'raster', help='per-tile histogram2d vs one-pass scatter rasterization')
+    raster_parser.add_argument('--points', type=int, default=2_000_000)
+    raster_parser.add_argument('--extent', type=float, default=100.0)
+    raster_parser.add_argument('--grids', type=int, default=4)
+    raster_parser.add_argument('--img-size', type=int, default=512)
+    raster_parser.set_defaults(func=bench_raster)
+
+    dataset_parser = subparsers.add_parser(
+        'dataset', help='RailDataset decode per access vs memory-mapped cache')
+    dataset_parser.add_argument('--tiles', type=int, default=64)
+    dataset_parser.add_argument('--epochs', type=int, default=3)
+    dataset_parser.add_argument('--workers', type=int, default=0,
+                                help='DataLoader worker processes')
+    dataset_parser.set_defaults(func=bench_dataset)
+
+    model_parser = subparsers.add_parser(
+        'model', help='parameters, FLOPs and CPU latency of the legacy network vs RailNet')
+    model_parser.add_argument('--batch-size', type=int, default=4)
+    model_parser.add_argument('--repeat', type=int, default=5)
+    model_parser.add_argument('--threads', type=int, default=os.cpu_count())
+    model_parser.set_defaults(func=bench_model)
+
+    ddp_parser = subparsers.add_parser(
+        'ddp', help='distributed data-parallel training throughput for 1/2/4/8 local processes')
+    ddp_parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8])
+    ddp_parser.add_argument('--tiles', type=int, default=64)
+    ddp_parser.add_argument('--epochs', type=int, default=2)
+    ddp_parser.add_argument('--batch-size', type=int, default=4)
+    ddp_parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                            help='total threads, split between the processes')
+    ddp_parser.set_defaults(func=bench_ddp)
+
+    export_parser = subparsers.add_parser(
+        'export', help='cold start, latency and drift of the state dict vs TorchScript vs int8 TorchScript')
+    export_parser.add_argument('--model',
+                               help='trained state dict; a model fitted briefly on synthetic tiles by default')
+    export_parser.add_argument('--tiles', type=int, default=16)
+    export_parser.add_argument('--steps', type=int, default=50,
+                               help='optimizer steps when fitting on synthetic tiles')
+    export_parser.add_argument('--batch-size', type=int, default=4)
+    export_parser.add_argument('--repeat', type=int, default=3)
+    export_parser.add_argument('--threads', type=int, default=os.cpu_count())
+    export_parser.set_defaults(func=bench_export)
+
+    suite_parser = subparsers.add_parser(
+        'suite', help='every pipeline stage on a synthetic LAS file with straight and curved rails')
+    suite_parser.add_argument('--points', type=int, default=2_000_000)
+    suite_parser.add_argument('--length', type=float, default=40.96,
+                              help='corridor length in metres, 10.24 m per tile')
+    suite_parser.add_argument('--width', type=float, default=20.48)
+    suite_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    suite_parser.add_argument('--batch-size', type=int, default=8,
+                              help='inference batch size')
+    suite_parser.add_argument('--threads', type=int, default=os.cpu_count())
+    suite_parser.add_argument('--output',
+                              help='write the results as JSON to this file')
+    suite_parser.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
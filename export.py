@@ -0,0 +1,74 @@
+import os
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from infer import dataset_tiles
+from tile_store import TileStore, read_image
+
+
+def calibration_inputs(root='data', count=32, scale=0.25):
+    # Tiles at model scale as (1, 1, H, W) tensors, spread over the dataset
+    store = TileStore(root) if TileStore.exists(root) else None
+    image_paths = sorted(image_path for tiles in dataset_tiles(root).values() for image_path in tiles.values())
+    inputs = []
+    for image_path in image_paths[::max(1, len(image_paths) // count)][:count]:
+        image = Image.fromarray(read_image(image_path, store))
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+        inputs.append(torch.from_numpy(np.asarray(image, dtype=np.float32) / 255)[None, None])
+    return inputs
+
+
+def quantize(model, inputs):
+    # Static int8 post-training quantization: observers are calibrated on real tiles, then the
+    # convolutions are replaced by quantized kernels. Dynamic quantization only covers linear and
+    # recurrent layers, which RailNet does not have.
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    prepared = prepare_fx(model, get_default_qconfig_mapping(), inputs[:1])
+    with torch.inference_mode():
+        for calibration_input in inputs:
+            prepared(calibration_input)
+    return convert_fx(prepared)
+
+
+def export_model(model, output_path, example_size=256):
+    # Frozen TorchScript, loadable with torch.jit.load and without the training code. Input sizes
+    # stay dynamic: the padding and cropping in RailNet.forward are traced as shape operations.
+    example = torch.rand(1, 1, example_size, example_size)
+    with torch.inference_mode():
+        exported = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+    torch.jit.save(exported, f'{output_path}.tmp')
+    os.replace(f'{output_path}.tmp', output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export the trained model as frozen TorchScript for infer.py and test.py')
+    parser.add_argument('--model', default='model.pth')
+    parser.add_argument('--output', default='model.pt')
+    parser.add_argument('--int8', action='store_true',
+                        help='quantize to int8, calibrated on tiles of --root')
+    parser.add_argument('--root', default='data')
+    parser.add_argument('--calibration-tiles', type=int, default=32)
+    parser.add_argument('--scale', type=float, default=0.25,
+                        help='tile scale used for calibration, as in infer.py')
+    args = parser.parse_args()
+
+    from train import RailNet
+
+    model = RailNet()
+    model.load_state_dict(torch.load(args.model, map_location='cpu'))
+    model.eval()
+    if args.int8:
+        inputs = calibration_inputs(args.root, args.calibration_tiles, args.scale)
+        if not inputs:
+            parser.error(f'No tiles in {args.root} to calibrate the int8 model on')
+        model = quantize(model, inputs)
+    export_model(model, args.output)
+    print(f'Saved {args.output}')
+
+
+if __name__ == '__main__':
+    main()
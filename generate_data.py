@@ -1,92 +1,475 @@
 import os
 import csv
+import argparse
+import multiprocessing
 import laspy
 import numpy as np
 import cv2
 import glob
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from rasterize import REDUCERS, rasterize_tiles
+import tile_store
+import spatial_index
+import pyramid
+import manifest
 
 
-def save_lidar_grid(las_data, mask, las_file_name):
-    las_out = laspy.create()
-    for dim_name in las_data.point_format.dimension_names:
-        dim_data = getattr(las_data, dim_name)[mask]
-        setattr(las_out, dim_name, dim_data)
+def save_lidar_grid(las_data, indices, las_file_name, compress=False):
+    # Slice the raw point records once and write them with the source header (point format, scales,
+    # offsets, VLRs); the writer works on its own copy of the header and updates counts and bounds
+    if compress:
+        las_file_name = f'{os.path.splitext(las_file_name)[0]}.laz'
+    with laspy.open(las_file_name, mode='w', header=las_data.header, do_compress=compress) as writer:
+        writer.write_points(las_data.points[indices])
 
-    las_out.write(las_file_name)
 
+def grid_edges(data_min, n_grids, tile_size, resolution):
+    return data_min + np.arange(n_grids + 1) * tile_size * resolution
 
-def extract_and_save_grid_images(input_las_path, img_size, resolution=0.01, z_min=-5, z_max=45):
-    # Load the LAS file
-    las_data = laspy.read(input_las_path)
-    x_data, y_data, z_data = np.array(las_data.x), np.array(
-        las_data.y), np.array(las_data.z)
 
-    x_min, x_max, y_min, y_max = x_data.min(), x_data.max(), y_data.min(), y_data.max()
+def tile_grid(x_min, x_max, y_min, y_max, img_size, resolution):
     x_grids, y_grids = int((x_max - x_min) / (img_size[0] * resolution)), int(
         (y_max - y_min) / (img_size[1] * resolution))
+    x_edges = grid_edges(x_min, x_grids, img_size[0], resolution)
+    y_edges = grid_edges(y_min, y_grids, img_size[1], resolution)
+    return x_edges, y_edges
 
-    # Create output directory folder which is name of the las file without extension
+
+def output_paths(input_las_path):
+    # Output directory folder which is name of the las file without extension
     output_dir = os.path.splitext(input_las_path)[0]
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    for y_idx in range(y_grids):
-        for x_idx in range(x_grids):
-            x_min_grid, x_max_grid = x_min + x_idx * \
-                img_size[0] * resolution, x_min + \
-                (x_idx + 1) * img_size[0] * resolution
-            y_min_grid, y_max_grid = y_min + y_idx * \
-                img_size[1] * resolution, y_min + \
-                (y_idx + 1) * img_size[1] * resolution
-
-            mask = (x_data >= x_min_grid) & (x_data < x_max_grid) & (
-                y_data >= y_min_grid) & (y_data < y_max_grid)
-
-            if np.any(mask):
-                x_points, y_points, z_points = x_data[mask], y_data[mask], z_data[mask]
-
-                hist, _, _ = np.histogram2d(y_points, x_points, bins=(img_size[1], img_size[0]),
-                                            range=[[y_min_grid, y_max_grid], [x_min_grid, x_max_grid]], weights=z_points)
-                hist_normalized = (hist - z_min) / (z_max - z_min)
-                img = (hist_normalized * 255).astype(np.uint8)
-
-                # Create file name for the grid with las file name and grid index
-                grid_name = f'{os.path.splitext(os.path.basename(input_las_path))[0]}_{x_idx}_{y_idx}'
-                grid_dirname = os.path.join(output_dir, grid_name)
-
-                if not os.path.exists(grid_dirname):
-                    os.makedirs(grid_dirname)
-
-                # Save image
-                image_filename = f'{grid_name}_image.png'
-                image_filepath = os.path.join(grid_dirname, image_filename)
-                cv2.imwrite(image_filepath, img)
-
-                # Save LAS file
-                lidar_filename = f'{grid_name}.las'
-                lidar_filepath = os.path.join(grid_dirname, lidar_filename)
-                save_lidar_grid(las_data, mask, lidar_filepath)
-
-                # Save metadata
-                metadata_filename = f'{grid_name}.csv'
-                metadata_filepath = os.path.join(
-                    grid_dirname, metadata_filename)
-
-                with open(metadata_filepath, 'w', newline='') as csvfile:
-                    csv_writer = csv.writer(csvfile)
-                    csv_writer.writerow(
-                        ['image_filename', 'grid_x', 'grid_y', 'x_min', 'y_min', 'x_max', 'y_max', 'z_min', 'z_max'])
-                    csv_writer.writerow([image_filename, x_idx, y_idx, x_min_grid,
-                                        y_min_grid, x_max_grid, y_max_grid, z_min, z_max])
-
-
-def generate_unlabelled_data():
+    las_name = os.path.splitext(os.path.basename(input_las_path))[0]
+    return output_dir, las_name
+
+
+def group_points_by_tile(x_data, y_data, x_edges, y_edges):
+    # Compute each point's tile index once and sort points so that every tile is a contiguous slice
+    x_grids, y_grids = len(x_edges) - 1, len(y_edges) - 1
+    x_idx = np.searchsorted(x_edges, x_data, side='right') - 1
+    y_idx = np.searchsorted(y_edges, y_data, side='right') - 1
+    inside = (x_idx >= 0) & (x_idx < x_grids) & (y_idx >= 0) & (y_idx < y_grids)
+
+    # Narrow integer keys let the stable sort use radix sort
+    tile_ids = np.where(inside, y_idx * x_grids + x_idx, x_grids * y_grids)
+    tile_ids = tile_ids.astype(np.min_scalar_type(x_grids * y_grids))
+    order = np.argsort(tile_ids, kind='stable')
+    counts = np.bincount(tile_ids, minlength=x_grids * y_grids + 1)[:-1]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return order, offsets
+
+
+def non_empty_tiles(offsets, x_grids):
+    # Tiles in row-major order as (x_idx, y_idx, start, stop) slices of the tile ordering
+    tiles = []
+    for tile_id in np.flatnonzero(np.diff(offsets)):
+        y_idx, x_idx = divmod(int(tile_id), x_grids)
+        tiles.append((x_idx, y_idx, int(
+            offsets[tile_id]), int(offsets[tile_id + 1])))
+    return tiles
+
+
+def save_grid(las_data, indices, img, x_idx, y_idx, x_edges, y_edges, z_min, z_max, output_dir, las_name,
+              compress=False):
+    x_min_grid, x_max_grid = x_edges[x_idx], x_edges[x_idx + 1]
+    y_min_grid, y_max_grid = y_edges[y_idx], y_edges[y_idx + 1]
+
+    # Create file name for the grid with las file name and grid index
+    grid_name = f'{las_name}_{x_idx}_{y_idx}'
+    grid_dirname = os.path.join(output_dir, grid_name)
+
+    if not os.path.exists(grid_dirname):
+        os.makedirs(grid_dirname)
+
+    # Save image
+    image_filename = f'{grid_name}_image.png'
+    image_filepath = os.path.join(grid_dirname, image_filename)
+    cv2.imwrite(image_filepath, img)
+
+    # Save LAS file
+    lidar_filename = f'{grid_name}.las'
+    lidar_filepath = os.path.join(grid_dirname, lidar_filename)
+    save_lidar_grid(las_data, indices, lidar_filepath, compress)
+
+    # Save metadata
+    metadata_filename = f'{grid_name}.csv'
+    metadata_filepath = os.path.join(
+        grid_dirname, metadata_filename)
+
+    with open(metadata_filepath, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(
+            ['image_filename', 'grid_x', 'grid_y', 'x_min', 'y_min', 'x_max', 'y_max', 'z_min', 'z_max'])
+        csv_writer.writerow([image_filename, x_idx, y_idx, x_min_grid,
+                            y_min_grid, x_max_grid, y_max_grid, z_min, z_max])
+
+
+def save_grid_records(header, records, tiles, x_edges, y_edges, img_size, z_min, z_max, output_dir, las_name,
+                      reducer='max', compress=False, store=None):
+    # Save a batch of tiles from raw point records grouped by tile, rasterizing the whole batch in one pass.
+    # Tiles are (x_idx, y_idx, start, stop) slices into records. With store=(tile array, first slot) the
+    # images go into a tile store instead of per-tile directories.
+    las_batch = laspy.LasData(
+        header, laspy.PackedPointRecord(records, header.point_format))
+    values = las_batch.intensity if reducer == 'intensity' else las_batch.z
+    images = rasterize_tiles(np.array(las_batch.x), np.array(las_batch.y), np.array(values, dtype=np.float64),
+                             tiles, x_edges, y_edges, img_size, z_min, z_max, reducer)
+
+    if store is not None:
+        tile_array, first_slot = store
+        tile_array[first_slot:first_slot + len(images)] = images
+        return
+
+    for img, (x_idx, y_idx, start, stop) in zip(images, tiles):
+        save_grid(las_batch, slice(start, stop), img, x_idx, y_idx, x_edges, y_edges, z_min, z_max,
+                  output_dir, las_name, compress)
+
+
+def shift_tiles(tiles):
+    # Make tile slices relative to the first tile of a contiguous batch
+    first = tiles[0][2]
+    return [(x_idx, y_idx, start - first, stop - first) for x_idx, y_idx, start, stop in tiles]
+
+
+def extract_and_save_grid_images(input_las_path, img_size, resolution=0.01, z_min=-5, z_max=45, reducer='max',
+                                 compress=False, tiles_per_batch=16, layout='directories', write_table=True):
+    # Load the LAS file
+    las_data = laspy.read(input_las_path)
+    x_data, y_data = np.array(las_data.x), np.array(las_data.y)
+
+    x_min, x_max, y_min, y_max = x_data.min(), x_data.max(), y_data.min(), y_data.max()
+    x_edges, y_edges = tile_grid(
+        x_min, x_max, y_min, y_max, img_size, resolution)
+    output_dir, las_name = output_paths(input_las_path)
+
+    order, offsets = group_points_by_tile(x_data, y_data, x_edges, y_edges)
+    spatial_index.save_point_index(input_las_path, x_edges, y_edges, offsets, order[:offsets[-1]],
+                                   las_data.header.point_count)
+    tiles = non_empty_tiles(offsets, len(x_edges) - 1)
+    root = os.path.dirname(input_las_path)
+    if layout == 'store':
+        tile_array = tile_store.create_source_array(
+            root, las_name, len(tiles), img_size)
+
+    for batch_start in range(0, len(tiles), tiles_per_batch):
+        batch = tiles[batch_start:batch_start + tiles_per_batch]
+        records = las_data.points.array[order[batch[0][2]:batch[-1][3]]]
+        store = (tile_array, batch_start) if layout == 'store' else None
+        save_grid_records(las_data.header, records, shift_tiles(batch), x_edges, y_edges, img_size, z_min, z_max,
+                          output_dir, las_name, reducer, compress, store)
+
+    if layout == 'store':
+        tile_array.flush()
+        if write_table:
+            tile_store.write_source_rows(root, las_name, tile_store.source_rows(
+                root, las_name, tiles, x_edges, y_edges, z_min, z_max))
+    return tiles, x_edges, y_edges
+
+
+def extract_and_save_grid_images_streaming(input_las_path, img_size, resolution=0.01, z_min=-5, z_max=45,
+                                           reducer='max', compress=False, memory_budget=512 * 1024 ** 2,
+                                           spill_dir=None, layout='directories', write_table=True):
+    # Same tiles as extract_and_save_grid_images, but the file is read in chunks and each tile's
+    # points are spilled to disk so memory stays within memory_budget (plus the largest single tile)
+    with laspy.open(input_las_path) as reader:
+        header = reader.header
+        point_format = header.point_format
+        # Per point we hold the raw record, its sorted copy, scaled x/y and the tile keys
+        chunk_size = max(1, memory_budget // (2 * (2 * point_format.size + 48)))
+
+        # First pass: extent of the scaled coordinates
+        x_min, x_max, y_min, y_max = np.inf, -np.inf, np.inf, -np.inf
+        for points in reader.chunk_iterator(chunk_size):
+            x_data, y_data = np.array(points.x), np.array(points.y)
+            x_min, x_max = min(x_min, x_data.min()), max(x_max, x_data.max())
+            y_min, y_max = min(y_min, y_data.min()), max(y_max, y_data.max())
+
+    x_edges, y_edges = tile_grid(
+        x_min, x_max, y_min, y_max, img_size, resolution)
+    output_dir, las_name = output_paths(input_las_path)
+    x_grids, y_grids = len(x_edges) - 1, len(y_edges) - 1
+
+    spill_dir = tempfile.mkdtemp(prefix=f'{las_name}_', dir=spill_dir)
+    try:
+        # Second pass: group each chunk by tile and append the raw records and point numbers to
+        # per-tile spill files
+        buffers = {}
+        buffered_bytes = 0
+        tile_counts = np.zeros(x_grids * y_grids, dtype=np.int64)
+        index_dtype = spatial_index.order_dtype(header.point_count)
+
+        def flush():
+            for tile_id, parts in buffers.items():
+                with open(os.path.join(spill_dir, f'{tile_id}.bin'), 'ab') as f:
+                    for records_part, _ in parts:
+                        records_part.tofile(f)
+                with open(os.path.join(spill_dir, f'{tile_id}.idx'), 'ab') as f:
+                    for _, index_part in parts:
+                        index_part.astype(index_dtype).tofile(f)
+            buffers.clear()
+
+        with laspy.open(input_las_path) as reader:
+            chunk_start = 0
+            for points in reader.chunk_iterator(chunk_size):
+                order, offsets = group_points_by_tile(
+                    np.array(points.x), np.array(points.y), x_edges, y_edges)
+                records = points.array[order[:offsets[-1]]]
+                for tile_id in np.flatnonzero(np.diff(offsets)):
+                    tile_slice = slice(offsets[tile_id], offsets[tile_id + 1])
+                    buffers.setdefault(tile_id, []).append(
+                        (records[tile_slice], chunk_start + order[tile_slice]))
+                tile_counts += np.diff(offsets)
+                chunk_start += len(points)
+                buffered_bytes += records.nbytes + offsets[-1] * 8
+                if buffered_bytes > memory_budget // 2:
+                    flush()
+                    buffered_bytes = 0
+        flush()
+
+        # Concatenate the spilled point numbers into the spatial index in tile order
+        offsets = np.concatenate(([0], np.cumsum(tile_counts)))
+        spatial_index.save_point_index(input_las_path, x_edges, y_edges, offsets)
+        point_order = np.lib.format.open_memmap(spatial_index.index_paths(input_las_path)[1], mode='w+',
+                                                dtype=index_dtype, shape=(int(offsets[-1]),))
+        for tile_id in np.flatnonzero(tile_counts):
+            point_order[offsets[tile_id]:offsets[tile_id + 1]] = np.fromfile(
+                os.path.join(spill_dir, f'{tile_id}.idx'), dtype=index_dtype)
+        point_order.flush()
+        del point_order
+
+        # Tiles are written in the same order as the in-memory path
+        tiles = [divmod(int(tile_id), x_grids)[::-1]
+                 for tile_id in np.flatnonzero(tile_counts)]
+        root = os.path.dirname(input_las_path)
+        if layout == 'store':
+            tile_array = tile_store.create_source_array(
+                root, las_name, len(tiles), img_size)
+
+        for slot, (x_idx, y_idx) in enumerate(tiles):
+            records = np.fromfile(os.path.join(
+                spill_dir, f'{y_idx * x_grids + x_idx}.bin'), dtype=point_format.dtype())
+            store = (tile_array, slot) if layout == 'store' else None
+            save_grid_records(header, records, [(x_idx, y_idx, 0, len(records))], x_edges, y_edges,
+                              img_size, z_min, z_max, output_dir, las_name, reducer, compress, store)
+
+        if layout == 'store':
+            tile_array.flush()
+            if write_table:
+                tile_store.write_source_rows(root, las_name, tile_store.source_rows(
+                    root, las_name, tiles, x_edges, y_edges, z_min, z_max))
+        return tiles, x_edges, y_edges
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def prepare_las_file(input_las_path, img_size, resolution, work_dir):
+    # Sort the point records by tile into a memory-mapped file that tile workers slice without pickling
+    las_data = laspy.read(input_las_path)
+    x_data, y_data = np.array(las_data.x), np.array(las_data.y)
+    x_edges, y_edges = tile_grid(x_data.min(), x_data.max(
+    ), y_data.min(), y_data.max(), img_size, resolution)
+    order, offsets = group_points_by_tile(x_data, y_data, x_edges, y_edges)
+    spatial_index.save_point_index(input_las_path, x_edges, y_edges, offsets, order[:offsets[-1]],
+                                   las_data.header.point_count)
+
+    points_path = os.path.join(
+        work_dir, f'{os.path.splitext(os.path.basename(input_las_path))[0]}.npy')
+    np.save(points_path, las_data.points.array[order[:offsets[-1]]])
+    return points_path, x_edges, y_edges, non_empty_tiles(offsets, len(x_edges) - 1)
+
+
+def save_grid_batch(input_las_path, points_path, tiles, x_edges, y_edges, img_size, z_min, z_max, reducer='max',
+                    compress=False, first_slot=None):
+    # With first_slot set the tile images are written into the source's tile store array
+    with laspy.open(input_las_path) as reader:
+        header = reader.header
+    output_dir, las_name = output_paths(input_las_path)
+    records = np.load(points_path, mmap_mode='r')
+    store = None
+    if first_slot is not None:
+        store = (np.load(tile_store.source_array_path(os.path.dirname(input_las_path), las_name), mmap_mode='r+'),
+                 first_slot)
+    save_grid_records(header, np.array(records[tiles[0][2]:tiles[-1][3]]), shift_tiles(tiles), x_edges, y_edges,
+                      img_size, z_min, z_max, output_dir, las_name, reducer, compress, store)
+    if store is not None:
+        store[0].flush()
+    return len(tiles)
+
+
+def save_pyramid(input_las_path, tiles, img_size, reducer='max', layout='directories'):
+    # Downsampled levels are built from the saved base tiles rather than from the points again
+    if not tiles:
+        return 0
+    root = os.path.dirname(input_las_path)
+    las_name = output_paths(input_las_path)[1]
+    if layout == 'store':
+        tile_array = np.load(tile_store.source_array_path(root, las_name), mmap_mode='r')
+        slots = {tuple(tile[:2]): slot for slot, tile in enumerate(tiles)}
+
+        def load_tile(x_idx, y_idx):
+            return tile_array[slots[(x_idx, y_idx)]]
+    else:
+        def load_tile(x_idx, y_idx):
+            return cv2.imread(tile_store.tile_image_path(root, las_name, x_idx, y_idx), cv2.IMREAD_GRAYSCALE)
+    return pyramid.build_pyramid(root, las_name, tiles, load_tile, img_size, reducer)
+
+
+def print_progress(files_done, files_total, tiles_done):
+    print(f'Generated {tiles_done} tiles ({files_done}/{files_total} LAS files)')
+
+
+def write_store_table(las_file_path, tiles, x_edges, y_edges, z_min, z_max):
+    root = os.path.dirname(las_file_path)
+    las_name = output_paths(las_file_path)[1]
+    tile_store.write_source_rows(root, las_name, tile_store.source_rows(
+        root, las_name, tiles, x_edges, y_edges, z_min, z_max))
+
+
+def generate_parallel(las_files, img_size, resolution, z_min, z_max, workers, streaming, memory_budget,
+                      tiles_per_task, progress, reducer='max', compress=False, layout='directories',
+                      build_pyramid=False):
+    # Files are tiled in worker processes, then their tiles are fanned out to the pool in batches and
+    # the pyramid is built once all of a file's tiles are saved. The tile store table is only written
+    # from this process. Returns the tiles of every file.
+    files_done, tiles_done = 0, 0
+    work_dir = tempfile.mkdtemp(prefix='rail_generate_')
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            pending = {}
+            for las_file_path in las_files:
+                if streaming:
+                    future = executor.submit(extract_and_save_grid_images_streaming, las_file_path, img_size,
+                                             resolution, z_min, z_max, reducer, compress,
+                                             memory_budget // workers, None, layout, False)
+                else:
+                    future = executor.submit(
+                        prepare_las_file, las_file_path, img_size, resolution, work_dir)
+                pending[future] = ('file', las_file_path)
+
+            remaining = {}
+            file_tiles = {}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, las_file_path = pending.pop(future)
+                    result = future.result()
+
+                    if kind == 'file' and streaming:
+                        tiles, x_edges, y_edges = result
+                        tiles_done += len(tiles)
+                        remaining[las_file_path] = 0
+                        file_tiles[las_file_path] = tiles, x_edges, y_edges
+                    elif kind == 'file':
+                        points_path, x_edges, y_edges, tiles = result
+                        remaining[las_file_path] = 0
+                        file_tiles[las_file_path] = tiles, x_edges, y_edges
+                        if layout == 'store':
+                            las_name = output_paths(las_file_path)[1]
+                            tile_store.create_source_array(os.path.dirname(
+                                las_file_path), las_name, len(tiles), img_size).flush()
+                        for start in range(0, len(tiles), tiles_per_task):
+                            future = executor.submit(save_grid_batch, las_file_path, points_path,
+                                                     tiles[start:start + tiles_per_task], x_edges, y_edges,
+                                                     img_size, z_min, z_max, reducer, compress,
+                                                     start if layout == 'store' else None)
+                            pending[future] = ('tiles', las_file_path)
+                            remaining[las_file_path] += 1
+                    elif kind == 'tiles':
+                        tiles_done += result
+                        remaining[las_file_path] -= 1
+
+                    if kind == 'pyramid':
+                        files_done += 1
+                    elif remaining[las_file_path] == 0:
+                        points_path = os.path.join(
+                            work_dir, f'{output_paths(las_file_path)[1]}.npy')
+                        if os.path.exists(points_path):
+                            os.remove(points_path)
+                        if layout == 'store':
+                            write_store_table(
+                                las_file_path, *file_tiles[las_file_path], z_min, z_max)
+                        if build_pyramid:
+                            future = executor.submit(save_pyramid, las_file_path, file_tiles[las_file_path][0],
+                                                     img_size, reducer, layout)
+                            pending[future] = ('pyramid', las_file_path)
+                        else:
+                            files_done += 1
+                    progress(files_done, len(las_files), tiles_done)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    # In the order of las_files rather than the order the workers finished in
+    return {las_file_path: file_tiles[las_file_path][0] for las_file_path in las_files}
+
+
+def generate_unlabelled_data(workers=1, streaming=False, memory_budget=512 * 1024 ** 2, tiles_per_task=16,
+                             progress=print_progress, reducer='max', compress=False, layout='directories',
+                             build_pyramid=False, incremental=True):
     # Get all LAS files in data directory
-    las_files = glob.glob('data/*.las')
-    for las_file_path in las_files:
-        img_size = (1024, 1024)
-        resolution = 0.01  # 1 cm per pixel
-        extract_and_save_grid_images(
-            las_file_path, img_size, resolution=resolution)
+    las_files = sorted(glob.glob('data/*.las'))
+    img_size = (1024, 1024)
+    resolution = 0.01  # 1 cm per pixel
+    z_min, z_max = -5, 45
+
+    # Only sources that are new, changed or generated with other parameters are processed; outputs of
+    # removed sources are deleted
+    params = {'img_size': list(img_size), 'resolution': resolution, 'z_min': z_min, 'z_max': z_max,
+              'reducer': reducer, 'compress': compress, 'layout': layout, 'pyramid': build_pyramid}
+    stale, states = manifest.stale_sources(
+        'data', las_files, params, force=not incremental)
+
+    if workers > 1 and stale:
+        generated = generate_parallel(stale, img_size, resolution, z_min, z_max, workers, streaming, memory_budget,
+                                      tiles_per_task, progress, reducer, compress, layout, build_pyramid)
+        manifest.record_sources('data', generated, states, params)
+    else:
+        tiles_done = 0
+        for files_done, las_file_path in enumerate(stale, 1):
+            if streaming:
+                tiles, _, _ = extract_and_save_grid_images_streaming(
+                    las_file_path, img_size, resolution=resolution, z_min=z_min, z_max=z_max,
+                    reducer=reducer, compress=compress, memory_budget=memory_budget, layout=layout)
+            else:
+                tiles, _, _ = extract_and_save_grid_images(
+                    las_file_path, img_size, resolution=resolution, z_min=z_min, z_max=z_max,
+                    reducer=reducer, compress=compress, tiles_per_batch=tiles_per_task, layout=layout)
+            if build_pyramid:
+                save_pyramid(las_file_path, tiles, img_size, reducer, layout)
+            manifest.record_sources(
+                'data', {las_file_path: tiles}, states, params)
+            tiles_done += len(tiles)
+            progress(files_done, len(stale), tiles_done)
     # Return True if the function successfully finished
     return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate unlabelled tiles from the LAS files in data/')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes (1 runs in this process)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='read LAS files in chunks for files larger than memory')
+    parser.add_argument('--memory-budget', type=int, default=512,
+                        help='memory budget in MB for streaming mode, shared between workers')
+    parser.add_argument('--tiles-per-task', type=int, default=16)
+    parser.add_argument('--reducer', choices=REDUCERS, default='max',
+                        help='how points are reduced into image pixels')
+    parser.add_argument('--layout', choices=['directories', 'store'], default='directories',
+                        help='per-tile directories of PNG/LAS/CSV, or a compact tile store of images')
+    parser.add_argument('--laz', action='store_true',
+                        help='write LAZ-compressed tile point clouds')
+    parser.add_argument('--pyramid', action='store_true',
+                        help='also build downsampled overview levels (2x, 4x, 8x, ...) of every LAS file')
+    parser.add_argument('--full', action='store_true',
+                        help='regenerate every LAS file, not only new or changed ones')
+    args = parser.parse_args()
+
+    generate_unlabelled_data(workers=args.workers, streaming=args.streaming,
+                             memory_budget=args.memory_budget * 1024 ** 2, tiles_per_task=args.tiles_per_task,
+                             reducer=args.reducer, compress=args.laz, layout=args.layout,
+                             build_pyramid=args.pyramid, incremental=not args.full)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import os
+import tile_store
+
+DERIVED_SUFFIXES = ('_segmentation.png', '_prediction.png')
+
+
+def source_of(image_path, root='data'):
+    # Image paths are built by joining onto root, so no path normalisation is needed
+    return image_path[len(root) + 1:].split(os.sep, 1)[0]
+
+
+def prediction_path(image_path):
+    # Predicted masks are named like the segmentation masks, next to the tile
+    return image_path.replace('.png', '_prediction.png')
+
+
+def cached_image_paths(root='data'):
+    # Tile paths from the tile store table and the generation manifest, without listing any tile
+    # directories. None when neither index exists.
+    # manifest is imported here, so loading a model through infer.py does not import the LAS tiling modules
+    import manifest
+
+    has_table = tile_store.TileStore.exists(root)
+    has_manifest = os.path.exists(manifest.manifest_path(root))
+    if not has_table and not has_manifest:
+        return None
+
+    image_paths = set()
+    for row in tile_store.read_table(root):
+        image_paths.add(os.path.join(root, row['image_path']))
+    for source, entry in manifest.read_manifest(root)['sources'].items():
+        for x_idx, y_idx in entry['tiles']:
+            image_paths.add(tile_store.tile_image_path(
+                root, source, x_idx, y_idx))
+    return sorted(image_paths)
+
+
+def walk_files(root):
+    # Files under root in sorted order, found with os.scandir one directory at a time
+    directories = [root]
+    while directories:
+        try:
+            entries = sorted(os.scandir(directories.pop()),
+                             key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir():
+                subdirectories.append(entry.path)
+            else:
+                yield entry.path
+        directories.extend(reversed(subdirectories))
+
+
+def scan_image_paths(root='data'):
+    # Fallback for data without an index, yielding tile images as they are found
+    for path in walk_files(root):
+        if path.endswith('.png') and not path.endswith(DERIVED_SUFFIXES):
+            yield path
+
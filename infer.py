@@ -0,0 +1,165 @@
+import os
+import time
+import argparse
+import numpy as np
+import cv2
+import torch
+from PIL import Image
+from image_list import cached_image_paths, prediction_path, scan_image_paths
+from model_loader import load_model
+from tile_store import TileStore, read_image
+
+IMAGE_SUFFIX = '_image.png'
+
+
+def tile_name_parts(image_path):
+    # Tile images are named <source>_<x>_<y>_image.png
+    grid_name = os.path.basename(image_path)[:-len(IMAGE_SUFFIX)]
+    source, x_idx, y_idx = grid_name.rsplit('_', 2)
+    return source, int(x_idx), int(y_idx)
+
+
+def blend_weights(height, width, overlap):
+    # 1 over the tile, falling off linearly across the margins taken from the neighbouring tiles
+    def ramp(size):
+        weights = np.minimum((np.arange(size) + 0.5) / overlap, 1) if overlap else np.ones(size)
+        return np.minimum(weights, weights[::-1])
+    return np.outer(ramp(height), ramp(width)).astype(np.float32)
+
+
+def overlap_regions(dx, dy, height, width, overlap):
+    # Slices of the window around a tile and of its neighbour (dx, dy) that cover the same pixels
+    window_slices, tile_slices = [], []
+    for offset, size in ((dy, height), (dx, width)):
+        start = overlap + offset * size
+        window_start, window_stop = max(start, 0), min(start + size, size + 2 * overlap)
+        if window_start >= window_stop:
+            return None
+        window_slices.append(slice(window_start, window_stop))
+        tile_slices.append(slice(window_start - start, window_stop - start))
+    return tuple(window_slices), tuple(tile_slices)
+
+
+def predict_source(model, tiles, store=None, scale=0.25, overlap=32, batch_size=8, threshold=0.5, progress=None):
+    # Predict every tile of one source in row-major batches. Each tile is run with a margin of overlap
+    # pixels from its neighbours, and the overlapping predictions are blended, so seams get the same
+    # context as tile centres. tiles maps (x_idx, y_idx) to image paths.
+    order = sorted(tiles, key=lambda tile: (tile[1], tile[0]))
+    full_height, full_width = read_image(tiles[order[0]], store).shape
+    height, width = round(full_height * scale), round(full_width * scale)
+    if overlap > min(height, width):
+        raise ValueError(f'Overlap of {overlap} pixels is larger than the scaled tile')
+    weights = blend_weights(height + 2 * overlap, width + 2 * overlap, overlap)
+    neighbours = [(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                  if overlap_regions(dx, dy, height, width, overlap) is not None]
+
+    scaled = {}
+
+    def scaled_tile(tile):
+        # Tiles at model scale, kept while later rows may still need them
+        if tile not in scaled:
+            image = Image.fromarray(read_image(tiles[tile], store))
+            scaled[tile] = np.asarray(image.resize(
+                (width, height), Image.BILINEAR), dtype=np.float32) / 255
+        return scaled[tile]
+
+    sums, weight_sums = {}, {}
+    for batch_start in range(0, len(order), batch_size):
+        batch = order[batch_start:batch_start + batch_size]
+        windows = np.zeros((len(batch), 1, height + 2 * overlap, width + 2 * overlap), dtype=np.float32)
+        for window, (x_idx, y_idx) in zip(windows, batch):
+            for dx, dy in neighbours:
+                if (x_idx + dx, y_idx + dy) in tiles:
+                    window_slices, tile_slices = overlap_regions(dx, dy, height, width, overlap)
+                    window[0][window_slices] = scaled_tile((x_idx + dx, y_idx + dy))[tile_slices]
+
+        with torch.inference_mode():
+            probabilities = torch.sigmoid(model(torch.from_numpy(windows)))[:, 0].numpy()
+
+        for probability, (x_idx, y_idx) in zip(probabilities * weights, batch):
+            for dx, dy in neighbours:
+                tile = (x_idx + dx, y_idx + dy)
+                if tile not in tiles:
+                    continue
+                window_slices, tile_slices = overlap_regions(dx, dy, height, width, overlap)
+                if tile not in sums:
+                    sums[tile] = np.zeros((height, width), dtype=np.float32)
+                    weight_sums[tile] = np.zeros((height, width), dtype=np.float32)
+                sums[tile][tile_slices] += probability[window_slices]
+                weight_sums[tile][tile_slices] += weights[window_slices]
+
+        # A tile is complete once the windows of all its neighbours are done
+        last_x, last_y = batch[-1]
+        done = [tile for tile in sums if batch_start + len(batch) == len(order)
+                or (last_y, last_x) >= (tile[1] + 1, tile[0] + 1)]
+        for tile in done:
+            probability = cv2.resize(sums.pop(tile) / weight_sums.pop(tile), (full_width, full_height),
+                                     interpolation=cv2.INTER_LINEAR)
+            output_path = prediction_path(tiles[tile])
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            cv2.imwrite(output_path, ((probability > threshold) * 255).astype(np.uint8))
+        for tile in [tile for tile in scaled if tile[1] < last_y - 1]:
+            del scaled[tile]
+        if progress is not None:
+            progress(len(batch))
+
+
+def dataset_tiles(root='data', sources=None):
+    # Tiles of every source as {source: {(x_idx, y_idx): image path}}
+    image_paths = cached_image_paths(root)
+    if image_paths is None:
+        image_paths = scan_image_paths(root)
+    tiles = {}
+    for image_path in image_paths:
+        if not image_path.endswith(IMAGE_SUFFIX):
+            continue
+        source, x_idx, y_idx = tile_name_parts(image_path)
+        if sources is None or source in sources:
+            tiles.setdefault(source, {})[(x_idx, y_idx)] = image_path
+    return tiles
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Predict rail masks for every tile, written next to each tile as <grid>_image_prediction.png')
+    parser.add_argument('root', nargs='?', default='data')
+    parser.add_argument('--model', default='model.pth',
+                        help='state dict from train.py or TorchScript from export.py')
+    parser.add_argument('--source', action='append',
+                        help='only tiles of this source LAS (repeatable)')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--scale', type=float, default=0.25,
+                        help='tile scale fed to the model, 0.25 matches the 256x256 training tiles')
+    parser.add_argument('--overlap', type=int, default=32,
+                        help='margin in model pixels taken from neighbouring tiles and blended across seams')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='intra-op threads')
+    parser.add_argument('--interop-threads', type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.set_num_interop_threads(args.interop_threads)
+    model = load_model(args.model)
+    store = TileStore(args.root) if TileStore.exists(args.root) else None
+    tiles = dataset_tiles(args.root, args.source)
+    total = sum(len(source_tiles) for source_tiles in tiles.values())
+
+    start = time.perf_counter()
+    tiles_done = 0
+
+    def progress(batch_tiles):
+        nonlocal tiles_done
+        tiles_done += batch_tiles
+        elapsed = time.perf_counter() - start
+        print(f'{tiles_done}/{total} tiles, {tiles_done / elapsed:.2f} tiles/s', end='\r', flush=True)
+
+    for source, source_tiles in sorted(tiles.items()):
+        predict_source(model, source_tiles, store, args.scale, args.overlap, args.batch_size, args.threshold,
+                       progress)
+    elapsed = time.perf_counter() - start
+    print(f'\nPredicted {tiles_done} tiles in {elapsed:.1f} s ({tiles_done / max(elapsed, 1e-9):.2f} tiles/s)')
+
+
+if __name__ == '__main__':
+    main()
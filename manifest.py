@@ -0,0 +1,114 @@
+import os
+import glob
+import json
+import hashlib
+import tile_store
+import spatial_index
+import pyramid
+
+MANIFEST_NAME = 'manifest.json'
+TILE_OUTPUTS = ('_image.png', '.las', '.laz', '.csv')
+
+
+def manifest_path(root):
+    return os.path.join(root, MANIFEST_NAME)
+
+
+def read_manifest(root):
+    if not os.path.exists(manifest_path(root)):
+        return {'sources': {}}
+    with open(manifest_path(root)) as f:
+        return json.load(f)
+
+
+def write_manifest(root, manifest):
+    temp_path = f'{manifest_path(root)}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path(root))
+
+
+def file_hash(file_path, chunk_size=1024 ** 2):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def source_state(las_file_path, entry=None):
+    # Size, mtime and content hash of a source; the hash is only recomputed when size or mtime changed
+    stat = os.stat(las_file_path)
+    state = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if entry is not None and all(entry.get(key) == value for key, value in state.items()):
+        state['sha256'] = entry['sha256']
+    else:
+        state['sha256'] = file_hash(las_file_path)
+    return state
+
+
+def is_up_to_date(entry, state, params):
+    # A touched but unchanged file is still up to date
+    return entry is not None and entry['sha256'] == state['sha256'] and entry['params'] == params
+
+
+def source_entry(state, params, tiles):
+    return {**state, 'params': params, 'tiles': [[int(tile[0]), int(tile[1])] for tile in tiles]}
+
+
+def remove_outputs(root, source, entry):
+    # Delete everything generated for a source. Annotations and masks next to the tiles are kept.
+    for x_idx, y_idx in entry['tiles']:
+        grid_name = f'{source}_{x_idx}_{y_idx}'
+        grid_dir = os.path.join(root, source, grid_name)
+        for suffix in TILE_OUTPUTS:
+            if os.path.exists(os.path.join(grid_dir, f'{grid_name}{suffix}')):
+                os.remove(os.path.join(grid_dir, f'{grid_name}{suffix}'))
+        if os.path.isdir(grid_dir) and not os.listdir(grid_dir):
+            os.rmdir(grid_dir)
+    source_dir = os.path.join(root, source)
+    if os.path.isdir(source_dir) and not os.listdir(source_dir):
+        os.rmdir(source_dir)
+
+    paths = [tile_store.source_array_path(root, source), pyramid.pyramid_path(root, source),
+             *spatial_index.index_paths(os.path.join(root, f'{source}.las')),
+             *glob.glob(pyramid.level_path(glob.escape(root), glob.escape(source), '*'))]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    if tile_store.TileStore.exists(root):
+        tile_store.write_source_rows(root, source, [])
+
+
+def stale_sources(root, las_files, params, force=False):
+    # Bring the manifest in line with the LAS files on disk: outputs of removed, changed or re-parameterised
+    # sources are deleted and their entries dropped. Returns the files to generate and their states.
+    manifest = read_manifest(root)
+    sources = manifest['sources']
+    names = {os.path.splitext(os.path.basename(path))[0]: path for path in las_files}
+
+    stale, states = [], {}
+    for source in list(sources):
+        if source not in names:
+            remove_outputs(root, source, sources.pop(source))
+    for source, las_file_path in names.items():
+        states[las_file_path] = source_state(las_file_path, sources.get(source))
+        if not force and is_up_to_date(sources.get(source), states[las_file_path], params):
+            # Keep the new mtime so the hash is not recomputed next time
+            sources[source].update(states[las_file_path])
+            continue
+        if source in sources:
+            remove_outputs(root, source, sources.pop(source))
+        stale.append(las_file_path)
+    write_manifest(root, manifest)
+    return stale, states
+
+
+def record_sources(root, generated, states, params):
+    # generated maps each generated LAS file to its tiles
+    manifest = read_manifest(root)
+    for las_file_path, tiles in generated.items():
+        source = os.path.splitext(os.path.basename(las_file_path))[0]
+        manifest['sources'][source] = source_entry(
+            states[las_file_path], params, tiles)
+    write_manifest(root, manifest)
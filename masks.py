@@ -0,0 +1,98 @@
+import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image, ImageDraw
+from annotations import rail_lines_path, read_rail_lines
+from image_list import cached_image_paths, scan_image_paths
+from tile_store import TileStore
+
+
+def mask_path(image_path):
+    return image_path.replace(".png", "_segmentation.png")
+
+
+def is_up_to_date(image_path):
+    # Masks newer than their rail lines are current; tiles without rail lines only need an empty mask once
+    segmentation_path = mask_path(image_path)
+    if not os.path.exists(segmentation_path):
+        return False
+    lines_path = rail_lines_path(image_path)
+    return not os.path.exists(lines_path) or os.path.getmtime(segmentation_path) >= os.path.getmtime(lines_path)
+
+
+def build_mask(image_path, size, line_width=10):
+    # All lines of a tile are drawn into one mask image
+    mask_image = Image.new('1', size, 0)
+    draw = ImageDraw.Draw(mask_image)
+    for rail_line in read_rail_lines(rail_lines_path(image_path)):
+        x1, y1, x2, y2 = rail_line["coordinates"]
+        draw.line((x1, y1, x2, y2), fill=1, width=line_width, joint='curve')
+    os.makedirs(os.path.dirname(mask_path(image_path)), exist_ok=True)
+    mask_image.save(mask_path(image_path))
+
+
+def build_mask_batch(jobs, line_width=10, force=False):
+    # jobs are (image_path, size) with size None when it has to be read from the PNG header
+    built = 0
+    for image_path, size in jobs:
+        if not force and is_up_to_date(image_path):
+            continue
+        if size is None:
+            with Image.open(image_path) as image:
+                size = image.size
+        build_mask(image_path, size, line_width)
+        built += 1
+    return len(jobs), built
+
+
+def build_masks(image_paths, root='data', line_width=10, workers=1, force=False, batch_size=64, progress=None):
+    # Sizes of tiles in the tile store come from the array shape, others from their PNG header
+    store = TileStore(root) if TileStore.exists(root) else None
+    jobs = [(image_path, store.image(image_path).shape[::-1] if store is not None and image_path in store else None)
+            for image_path in image_paths]
+    batches = [jobs[start:start + batch_size]
+               for start in range(0, len(jobs), batch_size)]
+
+    done, built = 0, 0
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(build_mask_batch, batch, line_width, force) for batch in batches]
+            for future in as_completed(futures):
+                batch_done, batch_built = future.result()
+                done, built = done + batch_done, built + batch_built
+                if progress is not None:
+                    progress(done, len(jobs), built)
+    else:
+        for batch in batches:
+            batch_done, batch_built = build_mask_batch(
+                batch, line_width, force)
+            done, built = done + batch_done, built + batch_built
+            if progress is not None:
+                progress(done, len(jobs), built)
+    return built
+
+
+def print_progress(done, total, built):
+    print(f'Checked {done}/{total} tiles, built {built} masks')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build segmentation masks from the rail line annotations')
+    parser.add_argument('root', nargs='?', default='data')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--line-width', type=int, default=10)
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild masks that are newer than their rail lines')
+    args = parser.parse_args()
+
+    image_paths = cached_image_paths(args.root)
+    if image_paths is None:
+        image_paths = list(scan_image_paths(args.root))
+    build_masks(image_paths, args.root, args.line_width,
+                args.workers, args.force, progress=print_progress)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+import zipfile
+import torch
+
+
+def is_torchscript(model_path):
+    # TorchScript archives hold the model code, state dicts only pickled tensors
+    with zipfile.ZipFile(model_path) as archive:
+        return any(name.split('/')[1:2] == ['code'] for name in archive.namelist())
+
+
+def load_model(model_path):
+    # Exported TorchScript models load without the training code; state dicts need RailNet from train.py
+    if is_torchscript(model_path):
+        return torch.jit.load(model_path, map_location='cpu').eval()
+    from train import RailNet
+
+    model = RailNet()
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    return model.eval()
@@ -0,0 +1,77 @@
+import math
+
+
+class NotchIndex:
+    # Uniform grid over notch positions. Notches are keyed by (line_index, notch) with notch 0 the start
+    # and 1 the end of a rail line. A radius query only visits the cells the radius overlaps.
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.positions = {}
+
+    @classmethod
+    def from_rail_lines(cls, rail_lines, cell_size=32):
+        index = cls(cell_size)
+        for line_index, rail_line in enumerate(rail_lines):
+            index.add_line(line_index, rail_line["coordinates"])
+        return index
+
+    def __len__(self):
+        return len(self.positions)
+
+    def cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def add(self, key, x, y):
+        self.positions[key] = (x, y)
+        self.cells.setdefault(self.cell(x, y), set()).add(key)
+
+    def remove(self, key):
+        cell = self.cell(*self.positions.pop(key))
+        self.cells[cell].discard(key)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def move(self, key, x, y):
+        self.remove(key)
+        self.add(key, x, y)
+
+    def add_line(self, line_index, coordinates):
+        x1, y1, x2, y2 = coordinates
+        self.add((line_index, 0), x1, y1)
+        self.add((line_index, 1), x2, y2)
+
+    def move_line(self, line_index, coordinates):
+        x1, y1, x2, y2 = coordinates
+        self.move((line_index, 0), x1, y1)
+        self.move((line_index, 1), x2, y2)
+
+    def remove_line(self, line_index):
+        # Later lines shift down by one, as in the rail line list
+        n_lines = max((key[0] for key in self.positions), default=-1) + 1
+        for notch in range(2):
+            self.remove((line_index, notch))
+        for later_index in range(line_index + 1, n_lines):
+            for notch in range(2):
+                x, y = self.positions[(later_index, notch)]
+                self.remove((later_index, notch))
+                self.add((later_index - 1, notch), x, y)
+
+    def within(self, x, y, radius, exclude_line=None):
+        # (distance, key) of the notches within radius of (x, y), closest first
+        (x_start, y_start), (x_stop, y_stop) = self.cell(x - radius, y - radius), self.cell(x + radius, y + radius)
+        matches = []
+        for cell_x in range(x_start, x_stop + 1):
+            for cell_y in range(y_start, y_stop + 1):
+                for key in self.cells.get((cell_x, cell_y), ()):
+                    if key[0] == exclude_line:
+                        continue
+                    notch_x, notch_y = self.positions[key]
+                    distance = math.hypot(x - notch_x, y - notch_y)
+                    if distance <= radius:
+                        matches.append((distance, key))
+        return sorted(matches)
+
+    def nearest(self, x, y, radius, exclude_line=None):
+        matches = self.within(x, y, radius, exclude_line)
+        return matches[0][1] if matches else None
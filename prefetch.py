@@ -0,0 +1,63 @@
+import queue
+import threading
+from collections import OrderedDict
+
+
+class PrefetchCache:
+    # Decodes images and their rail lines on a worker thread into an LRU cache capped by memory.
+    # load(path) returns (PIL image, rail lines). Paths finished by the worker are put on results, so the
+    # Tk thread can pick them up with after() and never touches Tk from the worker.
+    def __init__(self, load, memory_limit=512 * 1024 ** 2):
+        self.load = load
+        self.memory_limit = memory_limit
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.pending = []
+        self.results = queue.Queue()
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def request(self, paths):
+        # Replaces any earlier request that has not been decoded yet
+        with self.condition:
+            self.pending = [path for path in paths if path not in self.cache]
+            self.condition.notify()
+
+    def get(self, path):
+        with self.condition:
+            if path not in self.cache:
+                return None
+            self.cache.move_to_end(path)
+            return self.cache[path]
+
+    def put(self, path, image, rail_lines):
+        # Decoded images and their PhotoImage (filled in on the Tk thread) are counted twice
+        entry = {'image': image, 'rail_lines': rail_lines, 'photo': None,
+                 'nbytes': 2 * image.width * image.height * len(image.getbands())}
+        with self.condition:
+            if path in self.cache:
+                self.cache_bytes -= self.cache.pop(path)['nbytes']
+            self.cache[path] = entry
+            self.cache_bytes += entry['nbytes']
+            while self.cache_bytes > self.memory_limit and len(self.cache) > 1:
+                self.cache_bytes -= self.cache.popitem(last=False)[1]['nbytes']
+        return entry
+
+    def clear(self):
+        with self.condition:
+            self.pending = []
+            self.cache.clear()
+            self.cache_bytes = 0
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                path = self.pending.pop(0)
+            try:
+                image, rail_lines = self.load(path)
+            except (OSError, ValueError):
+                continue
+            self.put(path, image, rail_lines)
+            self.results.put(path)
@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import tile_store
+
+
+def pyramid_path(root, source):
+    return os.path.join(root, f'{source}_pyramid.npz')
+
+
+def level_path(root, source, level):
+    return os.path.join(root, f'{source}_pyramid_{level}.npy')
+
+
+def downsample(img, reducer='max'):
+    # Halve a tile image with 2x2 blocks; max keeps thin rails visible, other reducers average
+    height, width = img.shape[0] // 2 * 2, img.shape[1] // 2 * 2
+    blocks = img[:height, :width].reshape(height // 2, 2, width // 2, 2)
+    if reducer == 'max':
+        return blocks.max(axis=(1, 3))
+    return blocks.mean(axis=(1, 3)).astype(np.uint8)
+
+
+def build_pyramid(root, source, tiles, load_tile, img_size, reducer='max', levels=None):
+    # Level n tile (x, y) covers base tiles [x * 2^n, (x + 1) * 2^n) x [y * 2^n, (y + 1) * 2^n) at the
+    # base image size, and is computed from the four level n - 1 tiles below it
+    grid_size = (max(x_idx for x_idx, y_idx, *_ in tiles) + 1,
+                 max(y_idx for x_idx, y_idx, *_ in tiles) + 1)
+    if levels is None:
+        levels = int(np.ceil(np.log2(max(grid_size))))
+
+    level_tiles = sorted(((x_idx, y_idx) for x_idx, y_idx, *_ in tiles),
+                         key=lambda tile: (tile[1], tile[0]))
+    previous = load_tile
+    coordinates = {}
+    half_width, half_height = img_size[0] // 2, img_size[1] // 2
+
+    for level in range(1, levels + 1):
+        child_tiles = set(level_tiles)
+        level_tiles = sorted({(x_idx // 2, y_idx // 2) for x_idx, y_idx in child_tiles},
+                             key=lambda tile: (tile[1], tile[0]))
+        level_array = np.lib.format.open_memmap(level_path(root, source, level), mode='w+', dtype=np.uint8,
+                                                shape=(len(level_tiles), img_size[1], img_size[0]))
+        for slot, (x_idx, y_idx) in enumerate(level_tiles):
+            for dy in range(2):
+                for dx in range(2):
+                    child = (2 * x_idx + dx, 2 * y_idx + dy)
+                    if child in child_tiles:
+                        level_array[slot, dy * half_height:(dy + 1) * half_height,
+                                    dx * half_width:(dx + 1) * half_width] = downsample(previous(*child), reducer)
+        level_array.flush()
+        coordinates[f'level_{level}'] = np.array(
+            level_tiles, dtype=np.int64).reshape(-1, 2)
+
+        slots = {tile: slot for slot, tile in enumerate(level_tiles)}
+        previous = lambda x_idx, y_idx, level_array=level_array, slots=slots: level_array[slots[(x_idx, y_idx)]]
+
+    np.savez(pyramid_path(root, source), levels=levels, grid_size=grid_size, img_size=img_size,
+             level_0=np.array(sorted((x_idx, y_idx) for x_idx, y_idx, *_ in tiles), dtype=np.int64).reshape(-1, 2),
+             **coordinates)
+    return levels
+
+
+class Pyramid:
+    # Lazy tile access for every level of a source's pyramid; level 0 is read from the base tiles
+    def __init__(self, root, source, store=None):
+        self.root = root
+        self.source = source
+        self.store = store
+        with np.load(pyramid_path(root, source)) as pyramid:
+            self.levels = int(pyramid['levels'])
+            self.grid_size = tuple(int(size) for size in pyramid['grid_size'])
+            self.img_size = tuple(int(size) for size in pyramid['img_size'])
+            self.slots = [{tuple(int(i) for i in tile): slot for slot, tile in enumerate(pyramid[f'level_{level}'])}
+                          for level in range(self.levels + 1)]
+        self.arrays = {}
+
+    @staticmethod
+    def exists(root, source):
+        return os.path.exists(pyramid_path(root, source))
+
+    def has_tile(self, level, x_idx, y_idx):
+        return (x_idx, y_idx) in self.slots[level]
+
+    def tile(self, level, x_idx, y_idx):
+        if not self.has_tile(level, x_idx, y_idx):
+            return None
+        if level == 0:
+            return tile_store.read_image(tile_store.tile_image_path(self.root, self.source, x_idx, y_idx), self.store)
+        if level not in self.arrays:
+            self.arrays[level] = np.load(
+                level_path(self.root, self.source, level), mmap_mode='r')
+        return self.arrays[level][self.slots[level][(x_idx, y_idx)]]
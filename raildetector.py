@@ -1,11 +1,234 @@
 import os
-import json
+import bisect
+import itertools
 import tkinter as tk
-import glob
 from tkinter import filedialog, simpledialog
 from PIL import Image, ImageTk, ImageDraw
 import math
+import time
+import queue
+import threading
+import numpy as np
+from collections import OrderedDict
 from generate_data import generate_unlabelled_data
+from tile_store import TileStore, tile_image_path
+from pyramid import Pyramid
+from annotations import AnnotationStore, rail_lines_path, read_rail_lines
+from prefetch import PrefetchCache
+from masks import build_masks
+from serve import request_mask
+from vectorize import vectorize_mask
+from image_list import cached_image_paths, scan_image_paths, source_of
+from notch_index import NotchIndex
+
+ALL_SOURCES = "All sources"
+STATUS_FILTERS = ("All", "Labelled", "Unlabelled")
+
+
+def has_rail_lines(path):
+    # Empty or unreadable rail lines files count as unlabelled, like empty lines held in memory
+    try:
+        return bool(read_rail_lines(path))
+    except (OSError, ValueError):
+        return False
+
+
+def tk_color(color):
+    # Tk has no alpha, translucency is approximated with stipple patterns
+    return '#%02x%02x%02x' % tuple(color[:3])
+
+
+class PyramidViewer(tk.Toplevel):
+    # Zoomable overview of one source. Draws the coarsest pyramid level that still has a tile pixel per
+    # screen pixel and only reads the tiles in view, so finer tiles are fetched as the user zooms in.
+    # Scroll to zoom, drag to pan and double-click a tile to open it in the editor.
+    def __init__(self, detector, pyramid, size=(1024, 1024), cache_size=64):
+        super().__init__(detector)
+        self.title(f"Overview: {pyramid.source}")
+        self.detector = detector
+        self.pyramid = pyramid
+        self.tile_cache = OrderedDict()
+        self.cache_size = cache_size
+        self.photos = []
+        self.drag_start = None
+
+        # Base-level pixels per screen pixel and the base-level pixel at the top left of the view
+        mosaic_width = pyramid.grid_size[0] * pyramid.img_size[0]
+        mosaic_height = pyramid.grid_size[1] * pyramid.img_size[1]
+        self.min_scale = 0.25
+        self.max_scale = max(mosaic_width / size[0], mosaic_height / size[1], 1)
+        self.scale = self.max_scale
+        self.origin = [0.0, 0.0]
+
+        self.canvas = tk.Canvas(self, bg="black", width=size[0], height=size[1])
+        self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.canvas.bind("<Configure>", lambda event: self.render())
+        self.canvas.bind("<MouseWheel>", self.on_zoom)
+        self.canvas.bind("<Button-4>", self.on_zoom)
+        self.canvas.bind("<Button-5>", self.on_zoom)
+        self.canvas.bind("<ButtonPress-1>", self.on_drag_start)
+        self.canvas.bind("<B1-Motion>", self.on_drag)
+        self.canvas.bind("<ButtonRelease-1>", self.on_drag_end)
+        self.canvas.bind("<Double-Button-1>", self.on_open_tile)
+
+    def level(self):
+        return min(max(int(math.floor(math.log2(self.scale))), 0), self.pyramid.levels)
+
+    def tile_image(self, level, x_idx, y_idx):
+        key = (level, x_idx, y_idx)
+        if key in self.tile_cache:
+            self.tile_cache.move_to_end(key)
+            return self.tile_cache[key]
+        tile = self.pyramid.tile(level, x_idx, y_idx)
+        image = None if tile is None else Image.fromarray(np.array(tile))
+        self.tile_cache[key] = image
+        if len(self.tile_cache) > self.cache_size:
+            self.tile_cache.popitem(last=False)
+        return image
+
+    def render(self):
+        self.canvas.delete("all")
+        self.photos = []
+        level = self.level()
+        tile_width = self.pyramid.img_size[0] * 2 ** level
+        tile_height = self.pyramid.img_size[1] * 2 ** level
+        view_width = self.canvas.winfo_width() * self.scale
+        view_height = self.canvas.winfo_height() * self.scale
+
+        x_start = max(int(self.origin[0] // tile_width), 0)
+        y_start = max(int(self.origin[1] // tile_height), 0)
+        x_stop = int((self.origin[0] + view_width) // tile_width) + 1
+        y_stop = int((self.origin[1] + view_height) // tile_height) + 1
+        for y_idx in range(y_start, y_stop):
+            for x_idx in range(x_start, x_stop):
+                image = self.tile_image(level, x_idx, y_idx)
+                if image is None:
+                    continue
+                left, top = self.to_screen(x_idx * tile_width, y_idx * tile_height)
+                right, bottom = self.to_screen((x_idx + 1) * tile_width, (y_idx + 1) * tile_height)
+                if right - left < 1 or bottom - top < 1:
+                    continue
+                photo = ImageTk.PhotoImage(image.resize((right - left, bottom - top)))
+                self.photos.append(photo)
+                self.canvas.create_image(left, top, anchor=tk.NW, image=photo)
+
+    def to_screen(self, x, y):
+        return round((x - self.origin[0]) / self.scale), round((y - self.origin[1]) / self.scale)
+
+    def to_base(self, x, y):
+        return self.origin[0] + x * self.scale, self.origin[1] + y * self.scale
+
+    def on_zoom(self, event):
+        # Keep the base pixel under the cursor in place
+        zoom_in = event.num == 4 or event.delta > 0
+        base_x, base_y = self.to_base(event.x, event.y)
+        self.scale = min(max(self.scale / 1.25 if zoom_in else self.scale * 1.25, self.min_scale), self.max_scale)
+        self.origin = [base_x - event.x * self.scale, base_y - event.y * self.scale]
+        self.render()
+
+    def on_drag_start(self, event):
+        self.drag_start = (event.x, event.y)
+
+    def on_drag(self, event):
+        # Move the drawn tiles while dragging and fetch newly visible tiles on release
+        if self.drag_start is not None:
+            self.canvas.move("all", event.x - self.drag_start[0], event.y - self.drag_start[1])
+            self.origin[0] -= (event.x - self.drag_start[0]) * self.scale
+            self.origin[1] -= (event.y - self.drag_start[1]) * self.scale
+            self.drag_start = (event.x, event.y)
+
+    def on_drag_end(self, event):
+        self.drag_start = None
+        self.render()
+
+    def on_open_tile(self, event):
+        base_x, base_y = self.to_base(event.x, event.y)
+        x_idx, y_idx = int(base_x // self.pyramid.img_size[0]), int(base_y // self.pyramid.img_size[1])
+        image_path = tile_image_path(self.pyramid.root, self.pyramid.source, x_idx, y_idx)
+        if image_path in self.detector.image_paths:
+            self.detector.select_image(self.detector.image_paths.index(image_path))
+
+
+class VirtualList(tk.Frame):
+    # Scrollable list that only draws the rows in view, for lists of tens of thousands of tiles.
+    # Rows are labelled on demand by label(row) and on_select(row) is called when a row is clicked.
+    def __init__(self, master, on_select, row_height=20):
+        super().__init__(master)
+        self.on_select = on_select
+        self.row_height = row_height
+        self.n_rows = 0
+        self.label = None
+        self.top = 0
+        self.selected = None
+
+        # Take the colours of the themed Listbox this replaces
+        listbox = tk.Listbox(self)
+        self.colors = {option: listbox.cget(option) for option in
+                       ("background", "foreground", "selectbackground", "selectforeground")}
+        self.font = listbox.cget("font")
+        listbox.destroy()
+
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas = tk.Canvas(self, background=self.colors["background"], highlightthickness=0)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.canvas.bind("<Configure>", lambda event: self.render())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<MouseWheel>", lambda event: self.yview("scroll", -1 if event.delta > 0 else 1, "units"))
+        self.canvas.bind("<Button-4>", lambda event: self.yview("scroll", -3, "units"))
+        self.canvas.bind("<Button-5>", lambda event: self.yview("scroll", 3, "units"))
+
+    def visible_rows(self):
+        return max(self.canvas.winfo_height() // self.row_height, 1)
+
+    def set_rows(self, n_rows, label):
+        self.n_rows = n_rows
+        self.label = label
+        self.selected = None
+        self.scroll_to(self.top)
+
+    def scroll_to(self, top):
+        self.top = min(max(top, 0), max(self.n_rows - self.visible_rows(), 0))
+        self.render()
+
+    def yview(self, *args):
+        # Scrollbar protocol: ("moveto", fraction) or ("scroll", n, "units" | "pages")
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * self.n_rows))
+        elif args[0] == "scroll":
+            step = self.visible_rows() if args[2] == "pages" else 1
+            self.scroll_to(self.top + int(args[1]) * step)
+
+    def select(self, row):
+        self.selected = row
+        if row is not None and not self.top <= row < self.top + self.visible_rows():
+            self.scroll_to(row - self.visible_rows() // 2)
+        else:
+            self.render()
+
+    def on_click(self, event):
+        row = self.top + event.y // self.row_height
+        if row < self.n_rows:
+            self.select(row)
+            self.on_select(row)
+
+    def render(self):
+        self.canvas.delete("all")
+        width = self.canvas.winfo_width()
+        for row in range(self.top, min(self.top + self.visible_rows() + 1, self.n_rows)):
+            y = (row - self.top) * self.row_height
+            foreground = self.colors["foreground"]
+            if row == self.selected:
+                self.canvas.create_rectangle(0, y, width, y + self.row_height,
+                                             fill=self.colors["selectbackground"], outline="")
+                foreground = self.colors["selectforeground"]
+            self.canvas.create_text(4, y + self.row_height // 2, anchor=tk.W, text=self.label(row),
+                                    fill=foreground, font=self.font)
+        if self.n_rows:
+            self.scrollbar.set(self.top / self.n_rows,
+                               min((self.top + self.visible_rows()) / self.n_rows, 1))
+        else:
+            self.scrollbar.set(0, 1)
 
 
 class RailDetector(tk.Tk):
@@ -33,6 +256,25 @@ class RailDetector(tk.Tk):
         self.show_segmentation_mask = tk.BooleanVar()
         self.show_segmentation_mask.set(False)
 
+        # Decoded tile of the current image, reused until another image is shown
+        self.base_image_path = None
+        self.base_image = None
+        self.base_photo = None
+        # Rail lines held in memory while a notch is dragged, saved on release
+        self.drag_lines = None
+        self.drag_latencies = []
+        # Rail lines are edited in memory and written to disk shortly after the last change
+        self.annotations = AnnotationStore()
+        self.save_delay = 500
+        self.pending_save = None
+        # Grid index over the notches of the current image for hit-testing and snapping
+        self.notch_index = None
+        self.notch_index_path = None
+        # Neighbouring images are decoded ahead of navigation on a worker thread
+        self.prefetch_count = 4
+        self.prefetch = PrefetchCache(self.decode_image)
+        self.after(50, self.poll_prefetch)
+
         self.canvas = tk.Canvas(self, bg="white", width=1024, height=1024)
         self.canvas.pack(side=tk.RIGHT)
 
@@ -42,6 +284,10 @@ class RailDetector(tk.Tk):
         self.canvas.bind("<B1-Motion>", self.on_canvas_move)
         self.canvas.bind("<Delete>", self.delete_selected_line)
         self.canvas.bind("<Escape>", self.deselect_selected_line)
+        self.bind("<Control-z>", self.undo)
+        self.bind("<Control-y>", self.redo)
+        self.bind("<Control-Z>", self.redo)
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
 
         self.menu = tk.Menu(self)
         self.config(menu=self.menu)
@@ -50,96 +296,173 @@ class RailDetector(tk.Tk):
         self.menu.add_cascade(label="File", menu=self.file_menu)
 
         self.line_menu = tk.Menu(self.menu)
+        self.tile_store = TileStore('data') if TileStore.exists('data') else None
+        self.image_scan = None
         self.image_paths = self.load_image_list()
         self.image_index = 0
+        # Image indices shown in the list after filtering by label status and source
+        self.filtered = []
+        self.sources = []
+        # Whether a rail lines file exists for each image path checked so far
+        self.labelled_paths = {}
+        self.status_filter = tk.StringVar(value=STATUS_FILTERS[0])
+        self.source_filter = tk.StringVar(value=ALL_SOURCES)
         self.create_side_panel()
 
         self.update_image_display()
 
     def load_image_list(self):
-        data_path = 'data'
-        image_paths = sorted(glob.glob(os.path.join(
-            data_path, "**", "*.png"), recursive=True))
-        image_paths = [
-            path for path in image_paths if not path.endswith('_segmentation.png')]
-        return image_paths
-
-    def draw_lines(self, image):
-        rail_lines = self.load_rail_lines()
+        # Tiles come from the index written during generation; data without one is scanned in the background
+        image_paths = cached_image_paths('data')
+        if image_paths is not None:
+            self.image_scan = None
+            return image_paths
+        self.image_scan = scan_image_paths('data')
+        self.after(1, self.poll_scan)
+        return []
+
+    def poll_scan(self):
+        # Add scanned images a chunk at a time so the window stays responsive
+        if self.image_scan is None:
+            return
+        chunk = list(itertools.islice(self.image_scan, 2000))
+        first_images = not self.image_paths and chunk
+        self.image_paths.extend(chunk)
+        self.update_image_list()
+        if first_images:
+            self.update_image_display()
+        if chunk:
+            self.after(1, self.poll_scan)
+        else:
+            self.image_scan = None
 
-        for rail_line in rail_lines:
+    def draw_lines(self, rail_lines):
+        # Rail lines and their notches are canvas items tagged by line, so a drag only moves its own items
+        notch_radius = self.line_width * 0.75
+        for index, rail_line in enumerate(rail_lines):
             x1, y1, x2, y2 = rail_line["coordinates"]
-
-            # Draw rail lines with multiple lines with varying widths and decreasing opacity
-            line_image = Image.new(
-                'RGBA', image.size, (255, 255, 255, 0))
-            draw = ImageDraw.Draw(line_image)
-            draw.line((x1, y1, x2, y2), fill=self.line_color,
-                      width=self.line_width, joint='curve')
-            image = Image.alpha_composite(image, line_image)
-
-            # Draw rail line notches
-            # Draw notches between line segments
-            notch_radius = self.line_width * 0.75
-            draw = ImageDraw.Draw(line_image)
-            draw.ellipse((x1 - notch_radius, y1 - notch_radius, x1 + notch_radius, y1 + notch_radius),
-                         fill=self.line_notch_color)
-            draw.ellipse((x2 - notch_radius, y2 - notch_radius, x2 + notch_radius, y2 + notch_radius),
-                         fill=self.line_notch_color)
-           # Change notch color when selected
-            if self.selected_notch is not None and self.selected_rail_line_index is not None:
-                selected_notch_color = (255, 0, 0, 100)
-                selected_x, selected_y = rail_lines[self.selected_rail_line_index]["coordinates"][
-                    0 if self.selected_notch == 0 else 2
-                ], rail_lines[self.selected_rail_line_index]["coordinates"][
-                    1 if self.selected_notch == 0 else 3
-                ]
-                draw.ellipse((selected_x - notch_radius,
-                              selected_y - notch_radius,
-                              selected_x + notch_radius,
-                              selected_y + notch_radius), fill=selected_notch_color)
-
-            image = Image.alpha_composite(image, line_image)
-
-        return image
+            self.canvas.create_line(x1, y1, x2, y2, fill=tk_color(self.line_color), width=self.line_width,
+                                    capstyle=tk.ROUND, stipple="gray50", tags=("rail_line", f"line_{index}"))
+            for notch, (x, y) in enumerate(((x1, y1), (x2, y2))):
+                # Change notch color when selected
+                selected = index == self.selected_rail_line_index and notch == self.selected_notch
+                self.canvas.create_oval(x - notch_radius, y - notch_radius, x + notch_radius, y + notch_radius,
+                                        fill="red" if selected else tk_color(self.line_notch_color), outline="",
+                                        tags=("notch", f"notch_{index}_{notch}"))
+
+    def move_line_items(self, index, coordinates):
+        x1, y1, x2, y2 = coordinates
+        notch_radius = self.line_width * 0.75
+        self.canvas.coords(f"line_{index}", x1, y1, x2, y2)
+        for notch, (x, y) in enumerate(((x1, y1), (x2, y2))):
+            self.canvas.coords(f"notch_{index}_{notch}", x - notch_radius, y - notch_radius,
+                               x + notch_radius, y + notch_radius)
 
     def update_image_display(self):
         if self.image_paths:
             image_path = self.image_paths[self.image_index]
-            unlabelled_image = Image.open(image_path).convert('RGBA')
+            if image_path != self.base_image_path:
+                entry = self.prefetch.get(image_path)
+                if entry is None:
+                    entry = self.prefetch.put(
+                        image_path, *self.decode_image(image_path))
+                self.take_prefetched(image_path, entry)
+                self.base_image = entry['image']
+                self.base_photo = entry['photo']
+                self.base_image_path = image_path
+                self.prefetch_neighbours()
+            photo = self.base_photo
 
             if self.show_segmentation_mask.get():
-                segmentation_mask = self.generate_segmentation_mask(
-                    unlabelled_image)
-                unlabelled_image.putalpha(segmentation_mask)
+                masked_image = self.base_image.copy()
+                masked_image.putalpha(
+                    self.generate_segmentation_mask(masked_image))
+                photo = self.mask_photo = ImageTk.PhotoImage(masked_image)
                 self.show_lines.set(False)
 
+            self.canvas.config(width=self.base_image.width,
+                               height=self.base_image.height)
+            self.canvas.delete("all")
+            self.canvas.create_image(0, 0, anchor=tk.NW, image=photo, tags="base")
             if self.show_lines.get():
-                unlabelled_image = self.draw_lines(unlabelled_image)
+                self.draw_lines(self.load_rail_lines())
 
-            self.current_image = unlabelled_image
-            self.photo = ImageTk.PhotoImage(self.current_image)
-            self.canvas.config(width=self.current_image.width,
-                               height=self.current_image.height)
-            self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
+    def report_drag_latency(self):
+        # Time from a motion event to the canvas being redrawn, over the last drag
+        if self.drag_latencies:
+            p50, p95 = np.percentile(np.array(self.drag_latencies) * 1000, [50, 95])
+            self.status_label.config(
+                text=f"Drag latency p50 {p50:.1f} ms, p95 {p95:.1f} ms ({len(self.drag_latencies)} events)")
+            self.drag_latencies = []
 
     def update_image_list(self):
-        self.image_list.delete(0, tk.END)
-        for index, image_path in enumerate(self.image_paths):
-            self.image_list.insert(
-                tk.END, f"{index}: {os.path.basename(image_path)}")
+        status, source = self.status_filter.get(), self.source_filter.get()
+        self.filtered = [index for index, image_path in enumerate(self.image_paths)
+                         if self.matches_filter(image_path, status, source)]
+
+        sources = sorted({source_of(image_path) for image_path in self.image_paths})
+        if sources != self.sources:
+            self.sources = sources
+            menu = self.source_menu["menu"]
+            menu.delete(0, tk.END)
+            for option in [ALL_SOURCES] + sources:
+                menu.add_command(label=option, command=lambda option=option: self.set_source_filter(option))
+
+        self.image_list.set_rows(len(self.filtered), self.row_label)
+        self.image_list.select(self.current_row())
+
+    def matches_filter(self, image_path, status, source):
+        if source != ALL_SOURCES and source_of(image_path) != source:
+            return False
+        return status == "All" or self.is_labelled(image_path) == (status == "Labelled")
+
+    def is_labelled(self, image_path):
+        # Rail lines loaded in this session take precedence over the files found on disk
+        rail_lines = self.annotations.rail_lines.get(rail_lines_path(image_path))
+        if rail_lines is not None:
+            return bool(rail_lines)
+        # Only the listed images are checked, each once, rather than walking every directory under data
+        if image_path not in self.labelled_paths:
+            self.labelled_paths[image_path] = has_rail_lines(rail_lines_path(image_path))
+        return self.labelled_paths[image_path]
+
+    def row_label(self, row):
+        index = self.filtered[row]
+        return f"{index}: {os.path.basename(self.image_paths[index])}"
+
+    def current_row(self):
+        row = bisect.bisect_left(self.filtered, self.image_index)
+        if row < len(self.filtered) and self.filtered[row] == self.image_index:
+            return row
+        return None
+
+    def set_source_filter(self, source):
+        self.source_filter.set(source)
+        self.update_image_list()
+
+    def on_status_filter(self, status):
+        # Label status is looked up again whenever the filter is chosen
+        self.labelled_paths = {}
+        self.update_image_list()
 
     def create_side_panel(self):
         self.side_panel = tk.Frame(self, width=512)
         self.side_panel.pack(side=tk.LEFT, fill=tk.Y)
 
-        self.image_list = tk.Listbox(self.side_panel)
+        self.filter_frame = tk.Frame(self.side_panel)
+        self.filter_frame.pack(side=tk.TOP, fill=tk.X)
+        self.status_menu = tk.OptionMenu(
+            self.filter_frame, self.status_filter, *STATUS_FILTERS, command=self.on_status_filter)
+        self.status_menu.pack(side=tk.LEFT)
+        self.source_menu = tk.OptionMenu(
+            self.filter_frame, self.source_filter, ALL_SOURCES)
+        self.source_menu.pack(side=tk.LEFT, fill=tk.X, expand=True)
+
+        self.image_list = VirtualList(self.side_panel, self.on_image_select)
         self.image_list.pack(fill=tk.BOTH, expand=True)
 
         self.update_image_list()
 
-        self.image_list.bind("<<ListboxSelect>>", self.on_image_select)
-
         # Create a new frame for the buttons
         self.button_frame = tk.Frame(self.side_panel)
         self.button_frame.pack(side=tk.TOP, pady=5)
@@ -156,9 +479,20 @@ class RailDetector(tk.Tk):
             self.side_panel, text="Generate Segmentation Masks", command=self.generate_segmentation_masks)
         self.generate_segmentation_button.pack(side=tk.BOTTOM)
 
-        self.generate_segmentation_button = tk.Button(
+        self.generate_data_button = tk.Button(
             self.side_panel, text="Generate Unlabelled Data", command=self.generate_unlabelled_data)
-        self.generate_segmentation_button.pack(side=tk.BOTTOM)
+        self.generate_data_button.pack(side=tk.BOTTOM)
+
+        self.overview_button = tk.Button(
+            self.side_panel, text="Overview", command=self.open_overview)
+        self.overview_button.pack(side=tk.BOTTOM)
+
+        self.suggest_button = tk.Button(
+            self.side_panel, text="Suggest Lines", command=self.suggest_lines)
+        self.suggest_button.pack(side=tk.BOTTOM)
+
+        self.status_label = tk.Label(self.side_panel, text="")
+        self.status_label.pack(side=tk.BOTTOM)
 
         self.show_lines = tk.BooleanVar()
         self.show_lines.set(True)
@@ -175,15 +509,40 @@ class RailDetector(tk.Tk):
         # Prevent the side panel from resizing with its contents
         self.side_panel.pack_propagate(0)
 
-    def on_image_select(self, event):
-        index = int(self.image_list.curselection()[0])
+    def on_image_select(self, row):
+        self.image_index = self.filtered[row]
+        self.update_image_display()
+
+    def select_image(self, index):
         self.image_index = index
         self.update_image_display()
+        self.image_list.select(self.current_row())
+
+    def step_image(self, step):
+        # Move through the rows of the filtered list, also when the current image is filtered out
+        row = bisect.bisect_left(self.filtered, self.image_index)
+        if self.current_row() is not None:
+            row += step
+        elif step < 0:
+            row -= 1
+        if 0 <= row < len(self.filtered):
+            self.select_image(self.filtered[row])
+
+    def open_overview(self):
+        if not self.image_paths:
+            return
+        source = source_of(self.image_paths[self.image_index])
+        if not Pyramid.exists('data', source):
+            self.status_label.config(
+                text=f"No overview for {source}, generate data with the pyramid enabled")
+            return
+        PyramidViewer(self, Pyramid('data', source, self.tile_store))
 
     def delete_selected_line(self, event):
         if self.selected_rail_line_index is not None:
             rail_lines = self.load_rail_lines()
             rail_lines.pop(self.selected_rail_line_index)
+            self.get_notch_index().remove_line(self.selected_rail_line_index)
             self.save_rail_lines(rail_lines)
             self.selected_notch = None
             self.selected_rail_line_index = None
@@ -196,138 +555,85 @@ class RailDetector(tk.Tk):
             self.update_image_display()
 
     def on_canvas_move(self, event):
+        start = time.perf_counter()
         if self.selected_notch is not None and self.selected_rail_line_index is not None:
-            rail_lines = self.load_rail_lines()
-            rail_lines[self.selected_rail_line_index]["coordinates"][self.selected_notch *
-                                                                     2:self.selected_notch * 2 + 2] = [event.x, event.y]
-
-            for index, rail_line in enumerate(rail_lines):
-                if index != self.selected_rail_line_index:
-                    for coord_index in range(0, 4, 2):
-                        x, y = rail_line["coordinates"][coord_index:coord_index + 2]
-                        distance = math.sqrt(
-                            (event.x - x) ** 2 + (event.y - y) ** 2)
-                        if distance <= self.snap_distance:
-                            rail_lines[self.selected_rail_line_index]["coordinates"][self.selected_notch *
-                                                                                     2:self.selected_notch * 2 + 2] = [x, y]
-
-            self.save_rail_lines(rail_lines)
-        self.update_image_display()
+            if self.drag_lines is None:
+                self.drag_lines = self.load_rail_lines()
+            rail_lines = self.drag_lines
+            # Snap to the closest notch of another line
+            x, y = self.snap(event.x, event.y, self.selected_rail_line_index)
+            # A new list, so the lines held in the annotation store and its history are not changed
+            coordinates = list(rail_lines[self.selected_rail_line_index]["coordinates"])
+            coordinates[self.selected_notch * 2:self.selected_notch * 2 + 2] = [x, y]
+            rail_lines[self.selected_rail_line_index]["coordinates"] = coordinates
+            self.get_notch_index().move(
+                (self.selected_rail_line_index, self.selected_notch), x, y)
+
+            self.move_line_items(self.selected_rail_line_index,
+                                 rail_lines[self.selected_rail_line_index]["coordinates"])
+        elif self.start_pos is not None:
+            # Preview of the line being drawn
+            if self.current_line is None:
+                self.current_line = self.canvas.create_line(
+                    *self.start_pos, event.x, event.y, fill=tk_color(self.line_notch_color), width=self.line_width)
+            else:
+                self.canvas.coords(self.current_line, *
+                                   self.start_pos, event.x, event.y)
+        else:
+            return
+        self.canvas.update_idletasks()
+        self.drag_latencies.append(time.perf_counter() - start)
 
     def on_canvas_click(self, event):
         self.canvas.focus_set()
-        rail_lines = self.load_rail_lines()
 
-        # Check if the user clicked on a notch
-        for index, rail_line in enumerate(rail_lines):
-            for coord_index in range(0, 4, 2):
-                x, y = rail_line["coordinates"][coord_index:coord_index + 2]
-                distance = math.sqrt((event.x - x) ** 2 + (event.y - y) ** 2)
-                # If the user clicked on a notch, select it unless the user is holding shift
-                if distance <= self.notch_click_radius and not (event.state & 0x0001):
-                    self.selected_notch = coord_index // 2
-                    self.selected_rail_line_index = index
-                    return
+        # If the user clicked on a notch, select it unless the user is holding shift
+        notch = self.get_notch_index().nearest(
+            event.x, event.y, self.notch_click_radius)
+        if notch is not None and not (event.state & 0x0001):
+            self.selected_rail_line_index, self.selected_notch = notch
+            self.update_image_display()
+            return
 
         if self.selected_notch is not None:
             self.unselect_notch()
         else:
             self.start_line(event)
 
-    def start_line(self, event):
-        self.start_pos = (event.x, event.y)
-        self.current_line = self.canvas.create_line(
-            *self.start_pos, *self.start_pos, fill=self.line_notch_color, width=self.line_width
-        )
-        self.canvas.bind("<B1-Motion>", self.update_line)
-
-    def update_line(self, event):
-        if self.current_line:
-            self.canvas.coords(self.current_line, *
-                               self.start_pos, event.x, event.y)
-
-    def end_line(self, event):
-        if self.start_pos and self.current_line:
-            # Check if the end point is close to another notch and combine them
-            rail_lines = self.load_rail_lines()
-            for line_index, rail_line in enumerate(rail_lines):
-                x1, y1, x2, y2 = rail_line["coordinates"]
-                distance1 = math.sqrt(
-                    (event.x - x1) ** 2 + (event.y - y1) ** 2)
-                distance2 = math.sqrt(
-                    (event.x - x2) ** 2 + (event.y - y2) ** 2)
-                if distance1 <= self.notch_click_radius:
-                    self.start_pos = (x1, y1)
-                    self.combine_notches(line_index, 0)
-                    break
-                elif distance2 <= self.notch_click_radius:
-                    self.start_pos = (x2, y2)
-                    self.combine_notches(line_index, 1)
-                    break
-                x1, y1 = self.start_pos
-                x2, y2 = event.x, event.y
-
-                self.canvas.delete(self.current_line)
-                self.current_line = None
-                self.canvas.unbind("<B1-Motion>")
-
-                rail_line = {
-                    "coordinates": [x1, y1, x2, y2],
-                }
-
-                rail_lines = self.load_rail_lines()
-                rail_lines.append(rail_line)
-                self.save_rail_lines(rail_lines)
-                self.update_image_display()
-
-    def combine_notches(self, line_index, notch_index):
-        rail_lines = self.load_rail_lines()
-        self.selected_rail_line_index = line_index
-        self.selected_notch = notch_index
-        self.end_line(tk.Event())
-
     def unselect_notch(self):
         self.selected_notch = None
         self.selected_rail_line_index = None
         self.update_image_display()
 
-    def set_line_width(self):
-        width = simpledialog.askinteger(
-            "Line Width", "Enter line width:", initialvalue=self.line_width)
-        if width:
-            self.line_width = width
-
     def prev_image(self):
-        if self.image_index > 0:
-            self.image_index -= 1
-            self.update_image_display()
-            self.image_list.selection_clear(0, tk.END)
-            self.image_list.selection_set(self.image_index)
+        self.step_image(-1)
 
     def next_image(self):
-        if self.image_index < len(self.image_paths) - 1:
-            self.image_index += 1
-            self.update_image_display()
-            self.image_list.selection_clear(0, tk.END)
-            self.image_list.selection_set(self.image_index)
+        self.step_image(1)
 
     def start_line(self, event):
-        self.start_pos = event.x, event.y
+        self.start_pos = self.snap(event.x, event.y)
 
     def end_line(self, event):
+        if self.drag_lines is not None:
+            self.save_rail_lines(self.drag_lines)
+            self.drag_lines = None
+        self.report_drag_latency()
+
         if self.start_pos:
             x1, y1 = self.start_pos
-            x2, y2 = event.x, event.y
+            x2, y2 = self.snap(event.x, event.y)
             self.start_pos = None
+            self.current_line = None
 
+            rail_lines = self.load_rail_lines()
+            self.get_notch_index().add_line(len(rail_lines), (x1, y1, x2, y2))
             rail_line = {
-                "id": len(self.load_rail_lines()),
+                "id": len(rail_lines),
                 "type": "rail",
                 "color": self.line_color,
-                "coordinates": (x1, y1, x2, y2)
+                "coordinates": [x1, y1, x2, y2]
             }
-
-            rail_lines = self.load_rail_lines()
             rail_lines.append(rail_line)
             self.save_rail_lines(rail_lines)
             self.update_image_display()
@@ -338,6 +644,19 @@ class RailDetector(tk.Tk):
         if width:
             self.line_width = width
 
+    def get_notch_index(self):
+        # Rebuilt when another image is shown or after undo/redo, and updated in place on edits
+        rail_lines_path = self.get_rail_lines_path()
+        if self.notch_index_path != rail_lines_path:
+            self.notch_index = NotchIndex.from_rail_lines(
+                self.load_rail_lines(), self.snap_distance)
+            self.notch_index_path = rail_lines_path
+        return self.notch_index
+
+    def snap(self, x, y, exclude_line=None):
+        notch = self.get_notch_index().nearest(x, y, self.snap_distance, exclude_line)
+        return (x, y) if notch is None else self.notch_index.positions[notch]
+
     def save_image(self):
         print("Rail lines saved")
 
@@ -354,40 +673,219 @@ class RailDetector(tk.Tk):
         return mask_image
 
     def generate_segmentation_masks(self):
-        for image_path in self.image_paths:
-            self.image_index = self.image_paths.index(image_path)
-            unlabelled_image = Image.open(image_path).convert('RGBA')
-            segmentation_mask = self.generate_segmentation_mask(
-                unlabelled_image)
-            segmentation_mask_path = image_path.replace(
-                ".png", "_segmentation.png")
-            segmentation_mask.save(segmentation_mask_path)
-        print("Segmentation masks generated")
+        # Masks are built from the saved rail lines by a process pool, skipping masks that are up to date
+        self.flush_annotations()
+        self.generate_segmentation_button.config(state=tk.DISABLED)
+        self.status_label.config(text="Generating segmentation masks...")
+        self.mask_queue = queue.Queue()
+        image_paths = list(self.image_paths)
+
+        def progress(done, total, built):
+            self.mask_queue.put(
+                ("progress", f"Checked {done}/{total} tiles, built {built} masks"))
+
+        def run():
+            try:
+                built = build_masks(image_paths, 'data', self.line_width,
+                                    workers=os.cpu_count(), progress=progress)
+                self.mask_queue.put(("finished", built))
+            except Exception as error:
+                self.mask_queue.put(("error", error))
+
+        threading.Thread(target=run, daemon=True).start()
+        self.after(200, self.poll_masks)
+
+    def poll_masks(self):
+        while not self.mask_queue.empty():
+            kind, value = self.mask_queue.get()
+            if kind == "progress":
+                self.status_label.config(text=value)
+                continue
+
+            self.generate_segmentation_button.config(state=tk.NORMAL)
+            if kind == "error":
+                self.status_label.config(text=f"Mask generation failed: {value}")
+            else:
+                self.status_label.config(
+                    text=f"Segmentation masks generated ({value} built)")
+                print("Segmentation masks generated")
+            return
+        self.after(200, self.poll_masks)
 
     def generate_unlabelled_data(self):
-        finished = generate_unlabelled_data()
-        if finished:
-            self.image_paths = self.load_image_list()
-            self.image_index = 0
-            self.update_image_list()
+        # Run generation on a background thread and poll its progress so the UI stays responsive
+        self.generate_data_button.config(state=tk.DISABLED)
+        self.status_label.config(text="Generating unlabelled data...")
+        self.generation_queue = queue.Queue()
+
+        def progress(files_done, files_total, tiles_done):
+            self.generation_queue.put(
+                ("progress", f"Generated {tiles_done} tiles ({files_done}/{files_total} LAS files)"))
+
+        def run():
+            try:
+                # Keep adding to the tile store once the data has been migrated to one
+                layout = "store" if TileStore.exists('data') else "directories"
+                finished = generate_unlabelled_data(
+                    workers=os.cpu_count(), progress=progress, layout=layout, build_pyramid=True)
+                self.generation_queue.put(("finished", finished))
+            except Exception as error:
+                self.generation_queue.put(("error", error))
+
+        threading.Thread(target=run, daemon=True).start()
+        self.after(200, self.poll_generation)
+
+    def poll_generation(self):
+        while not self.generation_queue.empty():
+            kind, value = self.generation_queue.get()
+            if kind == "progress":
+                self.status_label.config(text=value)
+                continue
+
+            self.generate_data_button.config(state=tk.NORMAL)
+            if kind == "error":
+                self.status_label.config(
+                    text=f"Generation failed: {value}")
+                return
+            if value:
+                self.status_label.config(text="Generation finished")
+                self.base_image_path = None
+                self.prefetch.clear()
+                self.tile_store = TileStore(
+                    'data') if TileStore.exists('data') else None
+                self.image_paths = self.load_image_list()
+                self.image_index = 0
+                self.update_image_list()
+                self.update_image_display()
+            return
+        self.after(200, self.poll_generation)
+
+    def suggest_lines(self):
+        # The mask of the current tile is predicted by a running serve.py and vectorized on a worker
+        # thread; the lines are added in one undoable step
+        if not self.image_paths:
+            return
+        image_path = self.image_paths[self.image_index]
+        image = np.array(self.open_image(image_path).convert('L'))
+        self.suggest_button.config(state=tk.DISABLED)
+        self.status_label.config(text="Requesting suggested lines...")
+        self.suggest_queue = queue.Queue()
+
+        def run():
+            try:
+                self.suggest_queue.put(
+                    ("finished", vectorize_mask(request_mask(image) > 127)))
+            except Exception as error:
+                self.suggest_queue.put(("error", error))
+
+        threading.Thread(target=run, daemon=True).start()
+        self.after(100, self.poll_suggestions, image_path)
+
+    def poll_suggestions(self, image_path):
+        if self.suggest_queue.empty():
+            self.after(100, self.poll_suggestions, image_path)
+            return
+        kind, value = self.suggest_queue.get()
+        self.suggest_button.config(state=tk.NORMAL)
+        if kind == "error":
+            self.status_label.config(text=f"Suggesting lines failed: {value}")
+            return
+
+        # Added to the tile the request was made for, even if another one is shown by now
+        lines_path = rail_lines_path(image_path)
+        rail_lines = self.annotations.get(lines_path)
+        for coordinates in value:
+            rail_lines.append({
+                "id": len(rail_lines),
+                "type": "rail",
+                "color": self.line_color,
+                "coordinates": list(coordinates)
+            })
+        self.annotations.set(lines_path, rail_lines)
+        self.schedule_save()
+        self.status_label.config(text=f"Added {len(value)} suggested lines")
+        if lines_path == self.get_rail_lines_path():
+            self.notch_index_path = None
             self.update_image_display()
 
     def load_rail_lines(self):
-        rail_lines_path = self.get_rail_lines_path()
-        if os.path.exists(rail_lines_path):
-            with open(rail_lines_path, "r") as f:
-                rail_lines = json.load(f)
-        else:
-            rail_lines = []
-        return rail_lines
+        return self.annotations.get(self.get_rail_lines_path())
 
     def save_rail_lines(self, rail_lines):
-        rail_lines_path = self.get_rail_lines_path()
-        with open(rail_lines_path, "w") as f:
-            json.dump(rail_lines, f)
+        self.annotations.set(self.get_rail_lines_path(), rail_lines)
+        self.schedule_save()
+
+    def schedule_save(self):
+        # Debounce writes so a burst of edits is saved once
+        if self.pending_save is not None:
+            self.after_cancel(self.pending_save)
+        self.pending_save = self.after(self.save_delay, self.flush_annotations)
+
+    def flush_annotations(self):
+        self.pending_save = None
+        try:
+            self.annotations.flush()
+        except OSError as error:
+            self.status_label.config(text=f"Saving rail lines failed: {error}")
+
+    def undo(self, event=None):
+        if self.image_paths and self.annotations.undo(self.get_rail_lines_path()):
+            self.after_history_step()
+
+    def redo(self, event=None):
+        if self.image_paths and self.annotations.redo(self.get_rail_lines_path()):
+            self.after_history_step()
+
+    def after_history_step(self):
+        self.notch_index_path = None
+        self.selected_notch = None
+        self.selected_rail_line_index = None
+        self.schedule_save()
+        self.update_image_display()
+
+    def on_close(self):
+        if self.pending_save is not None:
+            self.after_cancel(self.pending_save)
+        self.flush_annotations()
+        self.destroy()
+
+    def open_image(self, image_path):
+        if self.tile_store is not None and image_path in self.tile_store:
+            return Image.fromarray(np.array(self.tile_store.image(image_path)))
+        return Image.open(image_path)
 
     def get_rail_lines_path(self):
-        return self.image_paths[self.image_index].replace(".png", "_rail_lines.json")
+        return rail_lines_path(self.image_paths[self.image_index])
+
+    def decode_image(self, image_path):
+        # Runs on the prefetch thread, so it must not touch Tk
+        image = self.open_image(image_path).convert('RGBA')
+        return image, read_rail_lines(rail_lines_path(image_path))
+
+    def prefetch_neighbours(self):
+        # Next and previous images in the filtered list, closest first
+        row = bisect.bisect_left(self.filtered, self.image_index)
+        paths = []
+        for offset in range(1, self.prefetch_count + 1):
+            for neighbour in (row + offset, row - offset):
+                if 0 <= neighbour < len(self.filtered):
+                    paths.append(self.image_paths[self.filtered[neighbour]])
+        self.prefetch.request(paths)
+
+    def take_prefetched(self, image_path, entry):
+        # PhotoImages can only be created on the Tk thread
+        if entry['photo'] is None:
+            entry['photo'] = ImageTk.PhotoImage(entry['image'])
+        self.annotations.preload(
+            rail_lines_path(image_path), entry['rail_lines'])
+
+    def poll_prefetch(self):
+        while not self.prefetch.results.empty():
+            image_path = self.prefetch.results.get()
+            entry = self.prefetch.get(image_path)
+            if entry is not None:
+                self.take_prefetched(image_path, entry)
+        self.after(50, self.poll_prefetch)
 
     def run(self):
         self.mainloop()
@@ -0,0 +1,82 @@
+import numpy as np
+
+REDUCERS = ('max', 'min', 'mean', 'count', 'intensity')
+
+
+def bin_indices(values, low, step, n_bins):
+    # Uniform bin index with the same edge handling as np.histogram2d, so points exactly on a
+    # pixel edge fall in the upper pixel
+    indices = ((values - low) / step).astype(np.intp)
+    indices -= values < indices * step + low
+    indices += values >= (indices + 1) * step + low
+    return np.clip(indices, 0, n_bins - 1, out=indices)
+
+
+def pixel_indices(x_data, y_data, tiles, x_edges, y_edges, img_size):
+    # Flat pixel index of every point into a (n_tiles, height, width) stack, rows along y as np.histogram2d.
+    # Tiles must cover the point arrays contiguously and in order.
+    x_idx = np.array([tile[0] for tile in tiles])
+    y_idx = np.array([tile[1] for tile in tiles])
+    counts = [stop - start for _, _, start, stop in tiles]
+
+    x_low, y_low = x_edges[x_idx], y_edges[y_idx]
+    x_step = (x_edges[x_idx + 1] - x_low) / img_size[0]
+    y_step = (y_edges[y_idx + 1] - y_low) / img_size[1]
+    cols = bin_indices(x_data, np.repeat(x_low, counts),
+                       np.repeat(x_step, counts), img_size[0])
+    rows = bin_indices(y_data, np.repeat(y_low, counts),
+                       np.repeat(y_step, counts), img_size[1])
+
+    pixels = np.repeat(np.arange(len(tiles)) * img_size[1], counts)
+    pixels += rows
+    pixels *= img_size[0]
+    pixels += cols
+    return pixels
+
+
+def rasterize(pixels, values, n_pixels, reducer='max'):
+    # Reduce point values into pixels with a single scatter; pixels without points are NaN
+    if reducer == 'count':
+        return np.bincount(pixels, minlength=n_pixels).astype(np.float64)
+
+    if reducer in ('mean', 'intensity'):
+        counts = np.bincount(pixels, minlength=n_pixels)
+        sums = np.bincount(pixels, weights=values, minlength=n_pixels)
+        return np.divide(sums, counts, out=np.full(n_pixels, np.nan), where=counts > 0)
+
+    if reducer == 'max':
+        raster = np.full(n_pixels, -np.inf)
+        np.maximum.at(raster, pixels, values)
+    elif reducer == 'min':
+        raster = np.full(n_pixels, np.inf)
+        np.minimum.at(raster, pixels, values)
+    else:
+        raise ValueError(f"Unknown reducer '{reducer}', expected one of {REDUCERS}")
+    raster[np.isinf(raster)] = np.nan
+    return raster
+
+
+def to_image(raster, reducer, z_min, z_max):
+    # Scale a (n_tiles, height, width) raster to uint8; heights use the z range, intensity the 16-bit
+    # range and count each tile's maximum. Empty pixels are 0.
+    if reducer == 'intensity':
+        low, high = 0, 65535
+    elif reducer == 'count':
+        low, high = 0, np.maximum(raster.max(axis=(1, 2), keepdims=True), 1)
+    else:
+        low, high = z_min, z_max
+    normalized = (raster - low) / (high - low)
+    np.clip(normalized, 0, 1, out=normalized)
+    np.nan_to_num(normalized, copy=False, nan=0)
+    normalized *= 255
+    return normalized.astype(np.uint8)
+
+
+def rasterize_tiles(x_data, y_data, values, tiles, x_edges, y_edges, img_size, z_min, z_max, reducer='max'):
+    # Rasterize all tiles of a batch in one vectorized pass. Points must be grouped by tile and tiles
+    # are (x_idx, y_idx, start, stop) slices into the point arrays.
+    pixels = pixel_indices(x_data, y_data, tiles, x_edges, y_edges, img_size)
+    n_pixels = len(tiles) * img_size[0] * img_size[1]
+    raster = rasterize(pixels, values, n_pixels, reducer).reshape(
+        len(tiles), img_size[1], img_size[0])
+    return to_image(raster, reducer, z_min, z_max)
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import cv2
+from PIL import Image
+
+DEFAULT_URL = 'http://127.0.0.1:8765'
+
+
+class MicroBatcher:
+    # Requests from the handler threads are queued and run together on one thread, in batches of up to
+    # max_batch_size that wait at most max_wait seconds after their first request for more to arrive.
+    # predict_batch maps an (N, H, W) float32 array to rail probabilities of the same shape.
+    def __init__(self, predict_batch, max_batch_size=8, max_wait=0.01, history=1000):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.requests = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def predict(self, image):
+        # Blocks until the batch holding this image has run
+        request = {'image': image, 'start': time.perf_counter(), 'done': threading.Event()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.perf_counter(), 0)))
+                except queue.Empty:
+                    break
+            # Images of different sizes can not be stacked, so they run as separate batches
+            by_shape = {}
+            for request in batch:
+                by_shape.setdefault(request['image'].shape, []).append(request)
+            for requests in by_shape.values():
+                self.run_batch(requests)
+
+    def run_batch(self, requests):
+        try:
+            probabilities = self.predict_batch(np.stack([request['image'] for request in requests]))
+            for request, probability in zip(requests, probabilities):
+                request['result'] = probability
+        except Exception as error:
+            for request in requests:
+                request['error'] = error
+        finished = time.perf_counter()
+        with self.lock:
+            self.batch_sizes.append(len(requests))
+            self.latencies.extend(finished - request['start'] for request in requests)
+            self.requests += len(requests)
+        for request in requests:
+            request['done'].set()
+
+    def metrics(self):
+        # Latency is from queueing to the end of the batch, over the last history requests
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = list(self.batch_sizes)
+        return {'queue_depth': self.queue.qsize(),
+                'requests': self.requests,
+                'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+                'max_batch_size': max(batch_sizes, default=0),
+                'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None}
+
+
+def scaled_size(image, scale):
+    # (width, height) of a tile at model scale
+    height, width = image.shape
+    return round(width * scale), round(height * scale)
+
+
+def predict_mask(batcher, image, scale=0.25, threshold=0.5):
+    # Mask of a grayscale tile at its own size, predicted at the training scale as in infer.py
+    height, width = image.shape
+    scaled = Image.fromarray(image).resize(scaled_size(image, scale), Image.BILINEAR)
+    probability = batcher.predict(np.asarray(scaled, dtype=np.float32) / 255)
+    probability = cv2.resize(probability, (width, height), interpolation=cv2.INTER_LINEAR)
+    return ((probability > threshold) * 255).astype(np.uint8)
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    # POST /predict with a PNG tile returns its mask as a PNG, GET /metrics the batching metrics as JSON
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = 0
+        if length <= 0:
+            self.send_error(400, 'Request body is empty')
+            return
+        body = self.rfile.read(length)
+        try:
+            image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        except cv2.error:
+            image = None
+        if image is None:
+            self.send_error(400, 'Request body is not an image')
+            return
+        if min(scaled_size(image, self.server.scale)) < 1:
+            self.send_error(400, f'Image of {image.shape[1]}x{image.shape[0]} pixels is too small for the model')
+            return
+        try:
+            mask = predict_mask(self.server.batcher, image, self.server.scale, self.server.threshold)
+        except Exception as error:
+            # The model failing on one tile should not drop the connection
+            self.send_error(500, f'Prediction failed: {error}')
+            return
+        self.send_body(cv2.imencode('.png', mask)[1].tobytes(), 'image/png')
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        self.send_body(json.dumps(self.server.batcher.metrics()).encode(), 'application/json')
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # One line per request would flood the console under load
+        pass
+
+
+class PredictionServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 resets connections when many clients send tiles at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def request_mask(image, url=DEFAULT_URL, timeout=30):
+    # Mask of a grayscale tile from a running server
+    request = urllib.request.Request(f'{url}/predict', data=cv2.imencode('.png', image)[1].tobytes(),
+                                     headers={'Content-Type': 'image/png'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return cv2.imdecode(np.frombuffer(response.read(), dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
+def request_metrics(url=DEFAULT_URL, timeout=30):
+    with urllib.request.urlopen(f'{url}/metrics', timeout=timeout) as response:
+        return json.load(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Keep the model loaded and serve rail masks for PNG tiles over HTTP')
+    parser.add_argument('--model', default='model.pth',
+                        help='state dict from train.py or TorchScript from export.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=10,
+                        help='longest wait after the first request of a batch for more to arrive')
+    parser.add_argument('--scale', type=float, default=0.25,
+                        help='tile scale fed to the model, 0.25 matches the 256x256 training tiles')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='intra-op threads')
+    args = parser.parse_args()
+
+    # The client helpers are used by the labelling tool, so torch is only imported by the server
+    import torch
+    from model_loader import load_model
+
+    torch.set_num_threads(args.threads)
+    model = load_model(args.model)
+
+    def predict_batch(images):
+        with torch.inference_mode():
+            return torch.sigmoid(model(torch.from_numpy(images)[:, None]))[:, 0].numpy()
+
+    server = PredictionServer((args.host, args.port), PredictionHandler)
+    server.batcher = MicroBatcher(predict_batch, args.max_batch_size, args.max_wait_ms / 1000)
+    server.scale = args.scale
+    server.threshold = args.threshold
+    print(f'Serving {args.model} on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import os
+import time
+import argparse
+import laspy
+import numpy as np
+from rasterize import rasterize_tiles
+
+
+def index_paths(las_file_path):
+    base = os.path.splitext(las_file_path)[0]
+    return f'{base}_index.npz', f'{base}_order.npy'
+
+
+def order_dtype(n_points):
+    return np.uint32 if n_points < 2 ** 32 else np.int64
+
+
+def save_point_index(las_file_path, x_edges, y_edges, offsets, order=None, n_points=None):
+    # Grid hash over the tile grid: offsets[tile_id]:offsets[tile_id + 1] is the range of the tile's
+    # points in the order file, which holds point numbers of the source LAS grouped by tile.
+    # Without order the caller writes the order file itself. The order dtype is chosen from n_points,
+    # the point count of the source LAS, as order can leave out points outside the grid.
+    index_path, order_path = index_paths(las_file_path)
+    np.savez(index_path, x_edges=x_edges, y_edges=y_edges, offsets=offsets)
+    if order is not None:
+        np.save(order_path, order.astype(order_dtype(n_points)))
+
+
+def polygon_contains(polygon, x_data, y_data):
+    # Even-odd rule, vectorized over points and looping over the polygon's edges
+    polygon = np.asarray(polygon, dtype=np.float64)
+    inside = np.zeros(len(x_data), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crosses = (y1 > y_data) != (y2 > y_data)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (y_data - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x_data < x_cross)
+    return inside
+
+
+def polyline_distance(polyline, x_data, y_data):
+    # Distance of every point to the closest segment of a polyline
+    polyline = np.asarray(polyline, dtype=np.float64)
+    distance = np.full(len(x_data), np.inf)
+    for (x1, y1), (x2, y2) in zip(polyline[:-1], polyline[1:]):
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        t = np.zeros(len(x_data)) if length == 0 else np.clip(
+            ((x_data - x1) * dx + (y_data - y1) * dy) / length, 0, 1)
+        np.minimum(distance, np.hypot(
+            x_data - (x1 + t * dx), y_data - (y1 + t * dy)), out=distance)
+    return distance
+
+
+class PointIndex:
+    # Tile and point queries on a source LAS without rereading it: the point records are memory-mapped
+    # and only the tiles a query touches are read. Only points inside the generated tile grid are indexed.
+    def __init__(self, las_file_path):
+        index_path, order_path = index_paths(las_file_path)
+        with np.load(index_path) as index:
+            self.x_edges, self.y_edges = index['x_edges'], index['y_edges']
+            self.offsets = index['offsets']
+        self.order = np.load(order_path, mmap_mode='r')
+        self.x_grids = len(self.x_edges) - 1
+
+        with laspy.open(las_file_path) as reader:
+            self.header = reader.header
+        if self.header.are_points_compressed:
+            self.records = laspy.read(las_file_path).points.array
+        else:
+            self.records = np.memmap(las_file_path, dtype=self.header.point_format.dtype(), mode='r',
+                                     offset=self.header.offset_to_point_data, shape=(self.header.point_count,))
+
+    def tiles_in_bbox(self, x_min, y_min, x_max, y_max):
+        # Non-empty tiles intersecting a bounding box, as (x_idx, y_idx)
+        x_start = max(np.searchsorted(self.x_edges, x_min, side='right') - 1, 0)
+        x_stop = min(np.searchsorted(self.x_edges, x_max, side='left'), self.x_grids)
+        y_start = max(np.searchsorted(self.y_edges, y_min, side='right') - 1, 0)
+        y_stop = min(np.searchsorted(
+            self.y_edges, y_max, side='left'), len(self.y_edges) - 1)
+
+        tiles = []
+        for y_idx in range(y_start, y_stop):
+            for x_idx in range(x_start, x_stop):
+                tile_id = y_idx * self.x_grids + x_idx
+                if self.offsets[tile_id + 1] > self.offsets[tile_id]:
+                    tiles.append((x_idx, y_idx))
+        return tiles
+
+    def tile_bounds(self, x_idx, y_idx):
+        return self.x_edges[x_idx], self.y_edges[y_idx], self.x_edges[x_idx + 1], self.y_edges[y_idx + 1]
+
+    def tile_points(self, tiles):
+        # Point records of whole tiles, read in file order
+        ranges = [self.order[self.offsets[y_idx * self.x_grids + x_idx]:
+                             self.offsets[y_idx * self.x_grids + x_idx + 1]] for x_idx, y_idx in tiles]
+        indices = np.sort(np.concatenate(ranges)) if ranges else np.zeros(0, dtype=np.int64)
+        return self.point_record(self.records[indices])
+
+    def point_record(self, records):
+        return laspy.ScaleAwarePointRecord(np.asarray(records), self.header.point_format,
+                                           self.header.scales, self.header.offsets)
+
+    def points_in_bbox(self, x_min, y_min, x_max, y_max):
+        points = self.tile_points(self.tiles_in_bbox(x_min, y_min, x_max, y_max))
+        x_data, y_data = np.array(points.x), np.array(points.y)
+        return points[(x_data >= x_min) & (x_data < x_max) & (y_data >= y_min) & (y_data < y_max)]
+
+    def points_in_polygon(self, polygon):
+        polygon = np.asarray(polygon, dtype=np.float64)
+        (x_min, y_min), (x_max, y_max) = polygon.min(axis=0), polygon.max(axis=0)
+        points = self.tile_points(self.tiles_in_bbox(x_min, y_min, x_max, y_max))
+        return points[polygon_contains(polygon, np.array(points.x), np.array(points.y))]
+
+    def points_in_corridor(self, polyline, half_width):
+        # Points within half_width of a polyline, e.g. a track centreline; only tiles near each segment are read
+        polyline = np.asarray(polyline, dtype=np.float64)
+        tiles = set()
+        for start, stop in zip(polyline[:-1], polyline[1:]):
+            low, high = np.minimum(start, stop) - half_width, np.maximum(start, stop) + half_width
+            tiles.update(self.tiles_in_bbox(low[0], low[1], high[0], high[1]))
+        points = self.tile_points(sorted(tiles))
+        return points[polyline_distance(polyline, np.array(points.x), np.array(points.y)) <= half_width]
+
+    def extract_image(self, x_min, y_min, x_max, y_max, resolution, reducer='max', z_min=-5, z_max=45):
+        # Re-rasterize a region at any resolution from the indexed points
+        img_size = (max(int(round((x_max - x_min) / resolution)), 1),
+                    max(int(round((y_max - y_min) / resolution)), 1))
+        x_edges = np.array([x_min, x_min + img_size[0] * resolution])
+        y_edges = np.array([y_min, y_min + img_size[1] * resolution])
+        points = self.points_in_bbox(x_edges[0], y_edges[0], x_edges[1], y_edges[1])
+        values = points.intensity if reducer == 'intensity' else points.z
+        return rasterize_tiles(np.array(points.x), np.array(points.y), np.array(values, dtype=np.float64),
+                               [(0, 0, 0, len(points))], x_edges, y_edges, img_size, z_min, z_max, reducer)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Query the spatial index built during generation')
+    parser.add_argument('las_file')
+    parser.add_argument('--bbox', type=float, nargs=4, required=True,
+                        metavar=('X_MIN', 'Y_MIN', 'X_MAX', 'Y_MAX'))
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    point_index = PointIndex(args.las_file)
+    tiles = point_index.tiles_in_bbox(*args.bbox)
+    points = point_index.points_in_bbox(*args.bbox)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f'{len(tiles)} tiles and {len(points)} points in {elapsed:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
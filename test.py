@@ -1,27 +1,28 @@
+import os
+import numpy as np
 import torch
-import torchvision.transforms as transforms
 from PIL import Image
-from train import RailNet
+from model_loader import load_model
 
-# Load the trained model
-model = RailNet()
-model.load_state_dict(torch.load('model.pth'))
-model.eval()
+# Load the trained model, the exported TorchScript from export.py when there is one
+model = load_model('model.pt' if os.path.exists('model.pt') else 'model.pth')
 
 # Load the image to test
 image_path = 'data/A_RP-A-1_ - Scanner 1_SIDE_A - 190307_230736_Scanner_1 - originalpoints/A_RP-A-1_ - Scanner 1_SIDE_A - 190307_230736_Scanner_1 - originalpoints_4_3/A_RP-A-1_ - Scanner 1_SIDE_A - 190307_230736_Scanner_1 - originalpoints_4_3_image.png'
 input_image = Image.open(image_path).convert('L')  # convert to grayscale
-input_tensor = transforms.ToTensor()(input_image).unsqueeze(0)
+# Same scale as the training tiles
+input_array = np.asarray(input_image.resize((256, 256), Image.BILINEAR), dtype=np.float32) / 255
+input_tensor = torch.from_numpy(input_array)[None, None]
 
 # Predict the mask for the input image
-with torch.no_grad():
+with torch.inference_mode():
     output = model(input_tensor)
 
-# Threshold the output mask to get binary mask
-threshold = torch.nn.Threshold(0.5, 0)
-binary_output = threshold(output)
+# Threshold the rail probability of every pixel to get binary mask
+binary_output = torch.sigmoid(output) > 0.5
 
-# Save the predicted mask
+# Save the predicted mask at the size of the input image
 output_mask = binary_output.squeeze().numpy().astype('uint8') * 255
-output_mask = Image.fromarray(output_mask)
+output_mask = Image.fromarray(output_mask).resize(
+    input_image.size, Image.NEAREST)
 output_mask.save('predicted_mask.png')
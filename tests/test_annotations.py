@@ -0,0 +1,88 @@
+import os
+import queue
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from annotations import AnnotationStore  # noqa: E402
+from raildetector import RailDetector, has_rail_lines  # noqa: E402
+
+
+def make_detector(tmp_path):
+    # RailDetector without a Tk window: only the state the line editing methods use
+    detector = RailDetector.__new__(RailDetector)
+    detector.image_paths = [str(tmp_path / 'tile_image.png')]
+    detector.image_index = 0
+    detector.annotations = AnnotationStore()
+    detector.line_color = (0, 0, 255, 80)
+    detector.snap_distance = 20
+    detector.notch_index = None
+    detector.notch_index_path = None
+    detector.start_pos = None
+    detector.current_line = None
+    detector.selected_notch = None
+    detector.selected_rail_line_index = None
+    detector.drag_lines = None
+    detector.drag_latencies = []
+    detector.pending_save = None
+    detector.save_delay = 500
+    detector.canvas = SimpleNamespace(update_idletasks=lambda: None)
+    detector.after = lambda *args: None
+    detector.after_cancel = lambda *args: None
+    detector.update_image_display = lambda: None
+    detector.move_line_items = lambda index, coordinates: None
+    detector.report_drag_latency = lambda: None
+    detector.suggest_button = SimpleNamespace(config=lambda **kwargs: None)
+    detector.status_label = SimpleNamespace(config=lambda **kwargs: None)
+    return detector
+
+
+def test_move_notch_of_new_line(tmp_path):
+    detector = make_detector(tmp_path)
+    path = detector.get_rail_lines_path()
+
+    # Draw a line, then drag its end notch to another point
+    detector.start_line(SimpleNamespace(x=10, y=10))
+    detector.end_line(SimpleNamespace(x=100, y=10))
+    detector.selected_rail_line_index, detector.selected_notch = 0, 1
+    detector.on_canvas_move(SimpleNamespace(x=100, y=200))
+    detector.end_line(SimpleNamespace(x=100, y=200))
+
+    assert detector.annotations.get(path)[0]["coordinates"] == [10, 10, 100, 200]
+    assert detector.annotations.undo(path)
+    assert detector.annotations.get(path)[0]["coordinates"] == [10, 10, 100, 10]
+
+
+def test_move_notch_of_suggested_line(tmp_path):
+    detector = make_detector(tmp_path)
+    path = detector.get_rail_lines_path()
+
+    # Suggested segments as tuples, the way they came from vectorize_mask before
+    detector.suggest_queue = queue.Queue()
+    detector.suggest_queue.put(("finished", [(0, 0, 50, 0), (0, 10, 50, 10)]))
+    detector.poll_suggestions(detector.image_paths[0])
+    detector.selected_rail_line_index, detector.selected_notch = 1, 0
+    detector.on_canvas_move(SimpleNamespace(x=5, y=20))
+    detector.end_line(SimpleNamespace(x=5, y=20))
+
+    rail_lines = detector.annotations.get(path)
+    assert [rail_line["coordinates"] for rail_line in rail_lines] == [[0, 0, 50, 0], [5, 20, 50, 10]]
+
+
+def test_set_stores_coordinates_as_lists(tmp_path):
+    store = AnnotationStore()
+    path = str(tmp_path / 'tile_image_rail_lines.json')
+    store.set(path, [{"id": 0, "type": "rail", "color": (0, 0, 255, 80), "coordinates": (1, 2, 3, 4)}])
+    assert store.get(path)[0]["coordinates"] == [1, 2, 3, 4]
+
+
+def test_empty_or_unreadable_rail_lines_are_unlabelled(tmp_path):
+    empty, broken, labelled = (tmp_path / 'empty.json', tmp_path / 'broken.json', tmp_path / 'labelled.json')
+    empty.write_text('[]')
+    broken.write_text('[{')
+    labelled.write_text('[{"id": 0, "type": "rail", "coordinates": [1, 2, 3, 4]}]')
+    assert not has_rail_lines(str(empty))
+    assert not has_rail_lines(str(broken))
+    assert not has_rail_lines(str(tmp_path / 'missing.json'))
+    assert has_rail_lines(str(labelled))
@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from manifest import read_manifest, record_sources, stale_sources  # noqa: E402
+
+PARAMS = {'img_size': [1024, 1024], 'resolution': 0.01}
+
+
+def generate(root, las_files, params=PARAMS):
+    # Record every stale source as generated with one tile, as generate_unlabelled_data does
+    stale, states = stale_sources(root, las_files, params)
+    record_sources(root, {las_file_path: [(0, 0)] for las_file_path in stale}, states, params)
+    return stale
+
+
+def make_sources(tmp_path, names=('a', 'b')):
+    paths = []
+    for name in names:
+        path = tmp_path / f'{name}.las'
+        path.write_bytes(name.encode() * 100)
+        paths.append(str(path))
+    return paths
+
+
+def test_new_sources_are_stale_once(tmp_path):
+    las_files = make_sources(tmp_path)
+    assert generate(str(tmp_path), las_files) == las_files
+    assert generate(str(tmp_path), las_files) == []
+
+
+def test_touched_but_unchanged_source_is_up_to_date(tmp_path):
+    las_files = make_sources(tmp_path)
+    generate(str(tmp_path), las_files)
+    os.utime(las_files[0], ns=(0, 0))
+    assert generate(str(tmp_path), las_files) == []
+
+
+def test_changed_source_or_params_are_stale(tmp_path):
+    las_files = make_sources(tmp_path)
+    generate(str(tmp_path), las_files)
+    with open(las_files[1], 'ab') as f:
+        f.write(b'more points')
+    assert generate(str(tmp_path), las_files) == [las_files[1]]
+    assert generate(str(tmp_path), las_files, {**PARAMS, 'resolution': 0.02}) == las_files
+
+
+def test_removed_source_and_its_tiles_are_dropped(tmp_path):
+    las_files = make_sources(tmp_path)
+    generate(str(tmp_path), las_files)
+    tile_path = tmp_path / 'b' / 'b_0_0' / 'b_0_0_image.png'
+    tile_path.parent.mkdir(parents=True)
+    tile_path.write_bytes(b'png')
+
+    os.remove(las_files[1])
+    assert generate(str(tmp_path), las_files[:1]) == []
+    assert list(read_manifest(str(tmp_path))['sources']) == ['a']
+    assert not (tmp_path / 'b').exists()
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rasterize import rasterize, rasterize_tiles  # noqa: E402
+
+# Points in pixels 0, 0, 2 and 3 of a four pixel raster; pixel 1 is empty
+PIXELS = np.array([0, 0, 2, 3])
+VALUES = np.array([1.0, 3.0, 5.0, 7.0])
+
+
+@pytest.mark.parametrize('reducer, expected', [
+    ('max', [3, np.nan, 5, 7]),
+    ('min', [1, np.nan, 5, 7]),
+    ('mean', [2, np.nan, 5, 7]),
+    ('intensity', [2, np.nan, 5, 7]),
+    ('count', [2, 0, 1, 1]),
+])
+def test_reducers(reducer, expected):
+    np.testing.assert_array_equal(rasterize(PIXELS, VALUES, 4, reducer), expected)
+
+
+def test_unknown_reducer():
+    with pytest.raises(ValueError):
+        rasterize(PIXELS, VALUES, 4, 'median')
+
+
+def test_tiles_match_histogram2d():
+    # Two 4x4 pixel tiles side by side, including points exactly on pixel and tile edges
+    rng = np.random.default_rng(0)
+    x_edges, y_edges = np.array([0.0, 4.0, 8.0]), np.array([0.0, 4.0])
+    x_data = np.concatenate([rng.uniform(0, 4, 200), [0.0, 1.0, 3.0], rng.uniform(4, 8, 200), [4.0, 6.0]])
+    y_data = np.concatenate([rng.uniform(0, 4, 200), [2.0, 0.0, 3.0], rng.uniform(0, 4, 200), [1.0, 2.0]])
+    z_data = rng.uniform(0, 10, len(x_data))
+    tiles = [(0, 0, 0, 203), (1, 0, 203, len(x_data))]
+
+    images = rasterize_tiles(x_data, y_data, z_data, tiles, x_edges, y_edges, (4, 4), 0, 10, 'count')
+    for image, (x_idx, y_idx, start, stop) in zip(images, tiles):
+        counts, _, _ = np.histogram2d(y_data[start:stop], x_data[start:stop], bins=4,
+                                      range=[y_edges[y_idx:y_idx + 2], x_edges[x_idx:x_idx + 2]])
+        expected = (counts / max(counts.max(), 1) * 255).astype(np.uint8)
+        np.testing.assert_array_equal(image, expected)
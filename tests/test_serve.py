@@ -0,0 +1,56 @@
+import os
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serve import MicroBatcher, PredictionHandler, PredictionServer, request_mask, request_metrics  # noqa: E402
+
+
+@pytest.fixture
+def server_url():
+    # A server on an ephemeral port whose model marks pixels brighter than the middle grey as rail
+    server = PredictionServer(('127.0.0.1', 0), PredictionHandler)
+    server.batcher = MicroBatcher(lambda images: images)
+    server.scale = 0.25
+    server.threshold = 0.5
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(f'{url}/predict', data=body, headers={'Content-Type': 'image/png'})
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request, timeout=10)
+    return error.value.code
+
+
+def test_predict_returns_mask_at_tile_size(server_url):
+    image = np.zeros((64, 48), dtype=np.uint8)
+    image[:, 24:] = 255
+    mask = request_mask(image, server_url)
+    assert mask.shape == image.shape
+    assert mask[:, :20].max() == 0 and mask[:, 28:].min() == 255
+
+
+def test_bad_requests_are_rejected(server_url):
+    assert post(server_url, b'') == 400
+    assert post(server_url, b'not a png') == 400
+    assert post(server_url, cv2.imencode('.png', np.zeros((2, 2), dtype=np.uint8))[1].tobytes()) == 400
+
+
+def test_metrics_count_requests(server_url):
+    for _ in range(3):
+        request_mask(np.zeros((32, 32), dtype=np.uint8), server_url)
+    metrics = request_metrics(server_url)
+    assert metrics['requests'] == 3
+    assert metrics['queue_depth'] == 0
+    assert 1 <= metrics['max_batch_size'] <= 3
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import laspy
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_data import group_points_by_tile  # noqa: E402
+from spatial_index import PointIndex, save_point_index  # noqa: E402
+
+
+def make_index(tmp_path):
+    # 2000 points over a 3x2 grid of 10 m tiles, with some points outside the grid
+    rng = np.random.default_rng(0)
+    las_path = str(tmp_path / 'source.las')
+    las_data = laspy.create(point_format=3, file_version='1.2')
+    las_data.header.offsets = [0.0, 0.0, 0.0]
+    las_data.header.scales = [0.001, 0.001, 0.001]
+    las_data.x = rng.uniform(-5, 35, 2000)
+    las_data.y = rng.uniform(-5, 25, 2000)
+    las_data.z = rng.uniform(0, 5, 2000)
+    las_data.write(las_path)
+
+    las_data = laspy.read(las_path)
+    x_data, y_data = np.array(las_data.x), np.array(las_data.y)
+    x_edges, y_edges = np.array([0.0, 10.0, 20.0, 30.0]), np.array([0.0, 10.0, 20.0])
+    order, offsets = group_points_by_tile(x_data, y_data, x_edges, y_edges)
+    save_point_index(las_path, x_edges, y_edges, offsets, order[:offsets[-1]], las_data.header.point_count)
+    return PointIndex(las_path), x_data, y_data
+
+
+def test_points_in_bbox_match_a_full_scan(tmp_path):
+    # Only points inside the tile grid are indexed
+    index, x_data, y_data = make_index(tmp_path)
+    in_grid = (x_data >= 0) & (x_data < 30) & (y_data >= 0) & (y_data < 20)
+    x_data, y_data = x_data[in_grid], y_data[in_grid]
+    for x_min, y_min, x_max, y_max in [(2, 3, 17, 14), (10, 10, 20, 20), (0, 0, 30, 20), (29, 19, 40, 40)]:
+        points = index.points_in_bbox(x_min, y_min, x_max, y_max)
+        inside = (x_data >= x_min) & (x_data < x_max) & (y_data >= y_min) & (y_data < y_max)
+        np.testing.assert_array_equal(np.sort(np.array(points.x)), np.sort(x_data[inside]))
+        np.testing.assert_array_equal(np.sort(np.array(points.y)), np.sort(y_data[inside]))
+
+
+def test_tiles_in_bbox(tmp_path):
+    index, _, _ = make_index(tmp_path)
+    assert index.tiles_in_bbox(2, 3, 17, 14) == [(0, 0), (1, 0), (0, 1), (1, 1)]
+    assert index.tiles_in_bbox(40, 40, 50, 50) == []
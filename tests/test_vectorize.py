@@ -0,0 +1,51 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from annotations import AnnotationStore, read_rail_lines, rail_lines_path  # noqa: E402
+from image_list import prediction_path  # noqa: E402
+from vectorize import rail_lines, vectorize_batch, vectorize_mask  # noqa: E402
+
+
+def write_prediction(image_path, mask):
+    cv2.imwrite(prediction_path(image_path), mask.astype(np.uint8) * 255)
+
+
+def test_mask_segments_are_lists_of_ints():
+    mask = np.zeros((64, 64), dtype=bool)
+    mask[30:33, 5:60] = True
+    segments = vectorize_mask(mask)
+    assert segments
+    for segment in segments:
+        assert type(segment) is list and len(segment) == 4
+        assert all(type(value) is int for value in segment)
+    assert vectorize_mask(np.zeros((64, 64), dtype=bool)) == []
+
+
+def test_segments_can_be_edited_in_the_store(tmp_path):
+    mask = np.zeros((64, 64), dtype=bool)
+    mask[5:60, 30:33] = True
+    store = AnnotationStore()
+    path = str(tmp_path / 'tile_image_rail_lines.json')
+    store.set(path, rail_lines(vectorize_mask(mask)))
+
+    lines = store.get(path)
+    lines[0]["coordinates"][0:2] = [1, 2]
+    store.set(path, lines)
+    assert store.get(path)[0]["coordinates"][0:2] == [1, 2]
+
+
+def test_batch_skips_tiles_without_rails(tmp_path):
+    empty, rail = str(tmp_path / 'empty_image.png'), str(tmp_path / 'rail_image.png')
+    write_prediction(empty, np.zeros((64, 64), dtype=bool))
+    mask = np.zeros((64, 64), dtype=bool)
+    mask[30:33, 5:60] = True
+    write_prediction(rail, mask)
+
+    assert vectorize_batch([empty, rail]) == (2, 1)
+    assert not os.path.exists(rail_lines_path(empty))
+    assert read_rail_lines(rail_lines_path(rail))
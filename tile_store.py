@@ -0,0 +1,165 @@
+import os
+import csv
+import glob
+import argparse
+import numpy as np
+import cv2
+
+TABLE_NAME = 'tiles.csv'
+TABLE_COLUMNS = ['source', 'index', 'image_path', 'grid_x', 'grid_y',
+                 'x_min', 'y_min', 'x_max', 'y_max', 'z_min', 'z_max']
+
+
+def table_path(root):
+    return os.path.join(root, TABLE_NAME)
+
+
+def source_array_path(root, source):
+    return os.path.join(root, f'{source}_tiles.npy')
+
+
+def tile_image_path(root, source, x_idx, y_idx):
+    # Tiles keep the path they would have in the per-tile directory layout, so annotations and masks
+    # stored next to them work the same for both layouts
+    grid_name = f'{source}_{x_idx}_{y_idx}'
+    return os.path.join(root, source, grid_name, f'{grid_name}_image.png')
+
+
+def create_source_array(root, source, n_tiles, img_size):
+    return np.lib.format.open_memmap(source_array_path(root, source), mode='w+', dtype=np.uint8,
+                                     shape=(n_tiles, img_size[1], img_size[0]))
+
+
+def source_rows(root, source, tiles, x_edges, y_edges, z_min, z_max):
+    # Table rows for the (x_idx, y_idx, ...) tiles of one source, in the order of their slots in the source array
+    rows = []
+    for index, (x_idx, y_idx, *_) in enumerate(tiles):
+        rows.append({'source': source, 'index': index,
+                     'image_path': os.path.relpath(tile_image_path(root, source, x_idx, y_idx), root),
+                     'grid_x': x_idx, 'grid_y': y_idx,
+                     'x_min': x_edges[x_idx], 'y_min': y_edges[y_idx],
+                     'x_max': x_edges[x_idx + 1], 'y_max': y_edges[y_idx + 1],
+                     'z_min': z_min, 'z_max': z_max})
+    return rows
+
+
+def read_table(root):
+    if not os.path.exists(table_path(root)):
+        return []
+    with open(table_path(root), newline='') as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def write_source_rows(root, source, rows):
+    # Replace the rows of one source in the table, writing to a temporary file first so readers never
+    # see a partial table. Sources are kept in name order, so the table does not depend on the order
+    # parallel workers finish in.
+    table = [row for row in read_table(root) if row['source'] != source]
+    table.extend(rows)
+    table.sort(key=lambda row: row['source'])
+    temp_path = f'{table_path(root)}.tmp'
+    with open(temp_path, 'w', newline='') as csvfile:
+        csv_writer = csv.DictWriter(csvfile, fieldnames=TABLE_COLUMNS)
+        csv_writer.writeheader()
+        csv_writer.writerows(table)
+    os.replace(temp_path, table_path(root))
+
+
+class TileStore:
+    # Random access to the tiles of every source through one memory-mapped array per source and the
+    # shared metadata table
+    def __init__(self, root='data'):
+        self.root = root
+        self.rows = read_table(root)
+        self.arrays = {}
+        self.index_by_path = {self.image_path(i): i for i in range(len(self.rows))}
+
+    @staticmethod
+    def exists(root='data'):
+        return os.path.exists(table_path(root))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        row = self.rows[index]
+        return self.source_array(row['source'])[int(row['index'])]
+
+    def __contains__(self, image_path):
+        return image_path in self.index_by_path
+
+    def source_array(self, source):
+        if source not in self.arrays:
+            self.arrays[source] = np.load(
+                source_array_path(self.root, source), mmap_mode='r')
+        return self.arrays[source]
+
+    def image_path(self, index):
+        return os.path.join(self.root, self.rows[index]['image_path'])
+
+    def image_paths(self):
+        return [self.image_path(index) for index in range(len(self.rows))]
+
+    def image(self, image_path):
+        return self[self.index_by_path[image_path]]
+
+
+def read_image(image_path, store=None):
+    # Grayscale tile image, from the tile store when it holds the tile and from disk otherwise
+    if store is not None and image_path in store:
+        return np.array(store.image(image_path))
+    return cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+
+
+def migrate(root='data', remove=False):
+    # Convert the per-tile directory layout (<source>/<grid>/<grid>_image.png + <grid>.csv) into a tile store
+    for source_dir in sorted(glob.glob(os.path.join(root, '*', ''))):
+        source = os.path.basename(os.path.normpath(source_dir))
+        metadata_files = sorted(glob.glob(os.path.join(source_dir, '*', '*.csv')))
+        tiles = []
+        for metadata_file in metadata_files:
+            with open(metadata_file, newline='') as csvfile:
+                metadata = next(csv.DictReader(csvfile))
+            image_file = os.path.join(os.path.dirname(
+                metadata_file), metadata['image_filename'])
+            if os.path.exists(image_file):
+                tiles.append((metadata, image_file, metadata_file))
+        if not tiles:
+            continue
+
+        first_image = cv2.imread(tiles[0][1], cv2.IMREAD_GRAYSCALE)
+        tile_array = create_source_array(
+            root, source, len(tiles), first_image.shape[::-1])
+        rows = []
+        for index, (metadata, image_file, _) in enumerate(tiles):
+            tile_array[index] = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+            rows.append({'source': source, 'index': index,
+                         'image_path': os.path.relpath(image_file, root),
+                         **{column: metadata[column] for column in TABLE_COLUMNS[3:]}})
+        tile_array.flush()
+        write_source_rows(root, source, rows)
+        print(f'Migrated {len(tiles)} tiles of {source}')
+
+        if remove:
+            # Annotations, masks and tile point clouds stay next to the tile paths
+            for _, image_file, metadata_file in tiles:
+                os.remove(image_file)
+                os.remove(metadata_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tile store tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='convert per-tile directories into a tile store')
+    migrate_parser.add_argument('root', nargs='?', default='data')
+    migrate_parser.add_argument('--remove', action='store_true',
+                                help='remove the migrated tile images and metadata files')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate(args.root, args.remove)
+
+
+if __name__ == '__main__':
+    main()
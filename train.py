@@ -1,33 +1,56 @@
 import torch.nn as nn
 import os
+import argparse
+import contextlib
+import hashlib
+import time
 import torch
 import torchvision
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 from PIL import Image
 from glob import glob
 from scandir import scandir
 import numpy as np
+from tile_store import TileStore, table_path
 
 # 1. Custom dataset class
 
 
 class RailDataset(Dataset):
-    def __init__(self, root_dir, transform=None):
+    def __init__(self, root_dir, transform=None, cache_dir=None):
         self.root_dir = root_dir
         self.transform = transform
-
-        self.image_files = sorted(
-            glob(os.path.join(root_dir, "*/*/*_image.png")))
-        self.mask_files = sorted(
-            glob(os.path.join(root_dir, "*/*/*_segmentation.png")))
+        self.tile_store = None
+        self.cache = None
+
+        if TileStore.exists(root_dir):
+            # Images come from the tile store, masks are the segmentation PNGs of labelled tiles
+            self.tile_store = TileStore(root_dir)
+            self.image_files, self.mask_files = [], []
+            for image_path in sorted(self.tile_store.image_paths()):
+                mask_path = image_path.replace(".png", "_segmentation.png")
+                if os.path.exists(mask_path):
+                    self.image_files.append(image_path)
+                    self.mask_files.append(mask_path)
+        else:
+            self.image_files = sorted(
+                glob(os.path.join(root_dir, "*/*/*_image.png")))
+            self.mask_files = sorted(
+                glob(os.path.join(root_dir, "*/*/*_segmentation.png")))
 
         if len(self.image_files) != len(self.mask_files):
             print
             raise ValueError(
                 "Number of image files and mask files do not match.")
 
+        if cache_dir is not None and len(self.image_files):
+            self.cache = self.load_cache(cache_dir)
+
     def __len__(self):
         return len(self.image_files)
 
@@ -49,9 +72,60 @@ class RailDataset(Dataset):
     def __len__(self):
         return len(self.image_files)
 
+    def cache_key(self):
+        # Transform parameters plus every file and its modification time, so any change builds a new cache
+        key = hashlib.sha256(repr(self.transform).encode())
+        paths = self.image_files + self.mask_files
+        if self.tile_store is not None:
+            paths.append(table_path(self.root_dir))
+        for path in paths:
+            key.update(path.encode())
+            if os.path.exists(path):
+                key.update(str(os.stat(path).st_mtime_ns).encode())
+        return key.hexdigest()[:16]
+
+    def load_cache(self, cache_dir):
+        key = self.cache_key()
+        images_path = os.path.join(cache_dir, f'{key}_images.npy')
+        masks_path = os.path.join(cache_dir, f'{key}_masks.npy')
+        if not (os.path.exists(images_path) and os.path.exists(masks_path)):
+            self.build_cache(images_path, masks_path)
+        # Copy-on-write maps give writable arrays, so tensors can share their memory
+        return np.load(images_path, mmap_mode='c'), np.load(masks_path, mmap_mode='c')
+
+    def build_cache(self, images_path, masks_path):
+        # Decode and transform every sample once into uint8 arrays. The transform must end in ToTensor on
+        # 8-bit images, so values are multiples of 1/255; masks are stored binarized.
+        os.makedirs(os.path.dirname(images_path), exist_ok=True)
+        image, mask = self.decode(0)
+        images = np.lib.format.open_memmap(f'{images_path}.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(self), *image.shape))
+        masks = np.lib.format.open_memmap(f'{masks_path}.tmp', mode='w+', dtype=np.uint8,
+                                          shape=(len(self), *mask.shape))
+        for idx in range(len(self)):
+            image, mask = self.decode(idx)
+            images[idx] = (image * 255).round().to(torch.uint8).numpy()
+            masks[idx] = (mask > 0).numpy()
+        images.flush()
+        masks.flush()
+        del images, masks
+        os.replace(f'{images_path}.tmp', images_path)
+        os.replace(f'{masks_path}.tmp', masks_path)
+
     def __getitem__(self, idx):
+        if self.cache is not None:
+            # uint8 tensors on the cache's memory, converted to float on the batch
+            images, masks = self.cache
+            return torch.from_numpy(images[idx]), torch.from_numpy(masks[idx])
+        return self.decode(idx)
+
+    def decode(self, idx):
         # Load image and mask
-        image = Image.open(self.image_files[idx]).convert('L')
+        if self.tile_store is not None:
+            image = Image.fromarray(
+                np.array(self.tile_store.image(self.image_files[idx])))
+        else:
+            image = Image.open(self.image_files[idx]).convert('L')
         mask = Image.open(self.mask_files[idx]).convert('L')
 
         # Apply transformations if specified
@@ -59,88 +133,276 @@ class RailDataset(Dataset):
             image = self.transform(image)
             mask = self.transform(mask)
 
-        # Convert mask to binary (0 or 1)
-        mask = torch.where(mask > 0, torch.tensor([1.0]), torch.tensor([0.0]))
-
+        # Masks are binarized on the batch
         return image, mask
 
 
 # 2. Define the neural network architecture
 
 
+def conv_block(in_channels, out_channels):
+    return nn.Sequential(
+        nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1, bias=False),
+        nn.BatchNorm2d(out_channels),
+        nn.ReLU(inplace=True),
+        nn.Conv2d(out_channels, out_channels, kernel_size=3, padding=1, bias=False),
+        nn.BatchNorm2d(out_channels),
+        nn.ReLU(inplace=True))
+
+
 class RailNet(nn.Module):
-    def __init__(self):
+    # Small U-Net: an encoder that halves the resolution at every stage, a decoder with skip connections
+    # and a per-pixel rail logit at input resolution. Inputs of any size are padded to a multiple of the
+    # total stride and the logits are cropped back.
+    def __init__(self, channels=(8, 16, 32, 64)):
         super(RailNet, self).__init__()
-        self.conv1 = nn.Conv2d(1, 16, kernel_size=3, padding=1)
-        self.conv2 = nn.Conv2d(16, 32, kernel_size=3, padding=1)
-        self.fc1 = nn.Linear(32 * 64 * 64, 128)
-        self.fc2 = nn.Linear(128, 1)
+        self.stride = 2 ** (len(channels) - 1)
+        self.encoders = nn.ModuleList(
+            [conv_block(in_channels, out_channels)
+             for in_channels, out_channels in zip((1,) + channels[:-1], channels)])
+        self.upsamples = nn.ModuleList(
+            [nn.ConvTranspose2d(in_channels, out_channels, kernel_size=2, stride=2)
+             for in_channels, out_channels in zip(channels[:0:-1], channels[-2::-1])])
+        self.decoders = nn.ModuleList(
+            [conv_block(2 * out_channels, out_channels) for out_channels in channels[-2::-1]])
+        self.head = nn.Conv2d(channels[0], 1, kernel_size=1)
 
     def forward(self, x):
-        x = F.relu(self.conv1(x))
-        x = F.max_pool2d(x, 2)
-        x = F.relu(self.conv2(x))
-        x = F.max_pool2d(x, 2)
-        x = x.view(-1, 32 * 64 * 64)
-        x = F.relu(self.fc1(x))
-        x = self.fc2(x)
-        return x
+        height, width = x.shape[-2:]
+        x = F.pad(x, (0, -width % self.stride, 0, -height % self.stride))
+
+        skips = []
+        for encoder in self.encoders[:-1]:
+            x = encoder(x)
+            skips.append(x)
+            x = F.max_pool2d(x, 2)
+        x = self.encoders[-1](x)
+        for upsample, decoder, skip in zip(self.upsamples, self.decoders, reversed(skips)):
+            x = decoder(torch.cat([upsample(x), skip], dim=1))
+        return self.head(x)[..., :height, :width]
 
 
 # 3. Set up the training loop
-def train(model, train_loader, criterion, optimizer, device):
+def batch_to_float(inputs, targets):
+    # Cached datasets yield uint8 images; masks are binarized for the whole batch at once
+    if inputs.dtype == torch.uint8:
+        inputs = inputs.float().div_(255)
+    return inputs, (targets > 0).float()
+
+
+def augment_batch(inputs, targets, min_scale=0.75):
+    # Random crop of each sample resized back to the input size, then random horizontal and vertical flips.
+    # Images and masks get the same crop and flips.
+    n, _, height, width = inputs.shape
+    scales = torch.empty(n).uniform_(min_scale, 1)
+    crops_inputs, crops_targets = [], []
+    for sample in range(n):
+        crop_height, crop_width = int(height * scales[sample]), int(width * scales[sample])
+        top = int(torch.randint(0, height - crop_height + 1, ()))
+        left = int(torch.randint(0, width - crop_width + 1, ()))
+        crops_inputs.append(F.interpolate(inputs[sample:sample + 1, :, top:top + crop_height, left:left + crop_width],
+                                          size=(height, width), mode='bilinear', align_corners=False))
+        crops_targets.append(F.interpolate(targets[sample:sample + 1, :, top:top + crop_height, left:left + crop_width],
+                                           size=(height, width), mode='nearest'))
+    inputs, targets = torch.cat(crops_inputs), torch.cat(crops_targets)
+
+    for dim in (-1, -2):
+        flip = (torch.rand(n, 1, 1, 1) < 0.5).to(inputs.device)
+        inputs = torch.where(flip, inputs.flip(dim), inputs)
+        targets = torch.where(flip, targets.flip(dim), targets)
+    return inputs, targets
+
+
+def train(model, train_loader, criterion, optimizer, device, augment=False, bf16=False, channels_last=False,
+          accumulate=1):
+    # Returns the mean loss over all ranks, the number of samples they trained on and the time spent
+    # waiting for the data loader. Gradients of accumulate batches are summed before each optimizer step.
     model.train()
     running_loss = 0.0
-    for inputs, targets in train_loader:
-        inputs, targets = inputs.to(device), targets.to(device)
+    samples = 0
+    stall_time = 0.0
+    batches = iter(train_loader)
+    optimizer.zero_grad()
+    step = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            inputs, targets = next(batches)
+        except StopIteration:
+            break
+        stall_time += time.perf_counter() - start
+
+        inputs, targets = batch_to_float(inputs.to(device, non_blocking=True),
+                                         targets.to(device, non_blocking=True))
+        if augment:
+            inputs, targets = augment_batch(inputs, targets)
+        if channels_last:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+
+        # Optimize once every accumulate batches, and on the last partial group. Distributed models only
+        # all-reduce gradients on the batch that steps.
+        step += 1
+        optimize = step % accumulate == 0 or step == len(train_loader)
+        sync = model.no_sync() if isinstance(
+            model, DistributedDataParallel) and not optimize else contextlib.nullcontext()
+
+        # Forward + backward, with a per-pixel loss against the mask
+        with sync:
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=bf16):
+                outputs = model(inputs)
+                loss = criterion(outputs, targets)
+            (loss / accumulate).backward()
+        if optimize:
+            optimizer.step()
+            optimizer.zero_grad()
 
-        # Flatten the target mask to a single value per image
-        targets = targets.view(targets.size(0), -1).mean(dim=1, keepdim=True)
+        # Print statistics
+        running_loss += loss.item() * inputs.size(0)
+        samples += inputs.size(0)
 
-        # Zero the parameter gradients
-        optimizer.zero_grad()
+    if dist.is_initialized():
+        totals = torch.tensor([running_loss, samples], dtype=torch.float64)
+        dist.all_reduce(totals)
+        running_loss, samples = totals.tolist()
+    return running_loss / samples, int(samples), stall_time
 
-        # Forward + backward + optimize
-        outputs = model(inputs)
-        loss = criterion(outputs, targets)
-        loss.backward()
-        optimizer.step()
 
-        # Print statistics
-        running_loss += loss.item() * inputs.size(0)
-    return running_loss / len(train_loader.dataset)
+def save_atomic(state, path):
+    # Write to a temporary file and rename it over the target, so a crash never leaves a partial file
+    torch.save(state, f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+
+
+def save_checkpoint(path, epoch, model, optimizer):
+    save_atomic({'epoch': epoch, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                 'rng_state': torch.get_rng_state()}, path)
+
+
+def load_checkpoint(path, model, optimizer):
+    # Returns the last completed epoch
+    checkpoint = torch.load(path, map_location='cpu')
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    torch.set_rng_state(checkpoint['rng_state'])
+    return checkpoint['epoch']
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process, None where the resource module is missing (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 
 # 4. Set up the main function to run the training
 
 
 def main():
-    # Load data
+    parser = argparse.ArgumentParser(description='Train the rail segmentation model')
+    parser.add_argument('--cache-dir',
+                        help='decode and resize the dataset once into memory-mapped arrays in this directory')
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count()),
+                        help='data loader worker processes (0 loads in the training process)')
+    parser.add_argument('--persistent-workers', action='store_true',
+                        help='keep data loader workers alive between epochs')
+    parser.add_argument('--prefetch-factor', type=int, default=2,
+                        help='batches loaded ahead by each worker')
+    parser.add_argument('--pin-memory', action=argparse.BooleanOptionalAction, default=torch.cuda.is_available(),
+                        help='pin batches in page-locked memory for faster copies to the GPU')
+    parser.add_argument('--augment', action='store_true',
+                        help='random crop and flip augmentation on each batch')
+    parser.add_argument('--bf16', action='store_true',
+                        help='bfloat16 autocast of the forward pass')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='channels_last memory format for the model and inputs')
+    parser.add_argument('--threads', type=int,
+                        help='intra-op threads, the torch default when not given')
+    parser.add_argument('--interop-threads', type=int)
+    parser.add_argument('--accumulate', type=int, default=1,
+                        help='batches per optimizer step, for an effective batch size of batch-size * accumulate')
+    parser.add_argument('--checkpoint', default='checkpoint.pth',
+                        help='model and optimizer state written atomically every --checkpoint-every epochs')
+    parser.add_argument('--checkpoint-every', type=int, default=1)
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from --checkpoint')
+    parser.add_argument('--backend', default='gloo',
+                        help='torch.distributed backend when launched with torchrun')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.interop_threads is not None:
+        torch.set_num_interop_threads(args.interop_threads)
+
+    # Launched by torchrun with more than one process: one data-parallel rank per process
+    distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    rank = 0
+    if distributed:
+        dist.init_process_group(args.backend)
+        rank = dist.get_rank()
+
+    # Load data. Rank 0 builds the dataset cache before the other ranks open it.
     train_transform = transforms.Compose([
         transforms.Resize((256, 256)),
         transforms.ToTensor()])
     data_root = 'data'
-    train_dataset = RailDataset(data_root, transform=train_transform)
-    train_loader = DataLoader(train_dataset, batch_size=4, shuffle=True)
+    if distributed and rank != 0:
+        dist.barrier()
+    train_dataset = RailDataset(
+        data_root, transform=train_transform, cache_dir=args.cache_dir)
+    if distributed and rank == 0:
+        dist.barrier()
+    sampler = DistributedSampler(train_dataset, shuffle=True) if distributed else None
+    loader_options = {}
+    if args.workers > 0:
+        loader_options = {'persistent_workers': args.persistent_workers,
+                          'prefetch_factor': args.prefetch_factor}
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=sampler is None,
+                              sampler=sampler, num_workers=args.workers, pin_memory=args.pin_memory,
+                              **loader_options)
 
     # Set up device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     # Initialize the model, loss, and optimizer
     model = RailNet().to(device)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
     criterion = torch.nn.BCEWithLogitsLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
-
-    # Training settings
-    num_epochs = 100
+    first_epoch = 1
+    if args.resume:
+        first_epoch = load_checkpoint(args.checkpoint, model, optimizer) + 1
+        if rank == 0:
+            print(f'Resuming from epoch {first_epoch}')
+    # Every rank starts from the same weights, which DistributedDataParallel broadcasts from rank 0
+    train_model = DistributedDataParallel(model) if distributed else model
 
     # Train the model
-    for epoch in range(1, num_epochs + 1):
-        train_loss = train(model, train_loader, criterion, optimizer, device)
-        print(f'Epoch: {epoch}, Loss: {train_loss:.4f}')
+    for epoch in range(first_epoch, args.epochs + 1):
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+        start = time.perf_counter()
+        train_loss, samples, stall_time = train(train_model, train_loader, criterion, optimizer, device,
+                                                args.augment, args.bf16, args.channels_last, args.accumulate)
+        samples_per_second = samples / (time.perf_counter() - start)
+        peak_rss = peak_rss_mb()
+        if rank == 0:
+            print(f'Epoch: {epoch}, Loss: {train_loss:.4f}, Loader stall: {stall_time:.2f} s, '
+                  f'{samples_per_second:.1f} samples/s'
+                  + (f', Peak RSS: {peak_rss:.0f} MB' if peak_rss is not None else ''))
+            if epoch % args.checkpoint_every == 0 or epoch == args.epochs:
+                save_checkpoint(args.checkpoint, epoch, model, optimizer)
 
     # Save the model
-    torch.save(model.state_dict(), 'model.pth')
+    if rank == 0:
+        save_atomic(model.state_dict(), 'model.pth')
+    if distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
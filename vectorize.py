@@ -0,0 +1,189 @@
+import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import cv2
+from annotations import rail_lines_path, write_json_atomic
+from image_list import cached_image_paths, prediction_path, scan_image_paths
+
+LINE_COLOR = (0, 0, 255, 80)
+KERNEL = np.ones((3, 3), dtype=np.uint8)
+
+
+def neighbours(image):
+    # P2..P9 of every pixel, clockwise from north, for an image padded by one pixel
+    return [image[:-2, 1:-1], image[:-2, 2:], image[1:-1, 2:], image[2:, 2:],
+            image[2:, 1:-1], image[2:, :-2], image[1:-1, :-2], image[:-2, :-2]]
+
+
+def transitions(p):
+    # 0 -> 1 transitions around the neighbourhood: 1 on a line, 3 or more where branches meet
+    return sum((p[i] == 0) & (p[(i + 1) % 8] == 1) for i in range(8))
+
+
+def removal_tables():
+    # Zhang-Suen removal conditions of both sub-iterations for every 8-bit neighbourhood code
+    codes = np.arange(256)
+    p = [(codes >> i) & 1 for i in range(8)]
+    count = sum(p)
+    keep_shape = (count >= 2) & (count <= 6) & (transitions(p) == 1)
+    first = keep_shape & (p[0] * p[2] * p[4] == 0) & (p[2] * p[4] * p[6] == 0)
+    second = keep_shape & (p[0] * p[2] * p[6] == 0) & (p[0] * p[4] * p[6] == 0)
+    return first.astype(np.uint8), second.astype(np.uint8)
+
+
+REMOVAL_TABLES = removal_tables()
+
+
+def thin(mask):
+    # Zhang-Suen thinning through a lookup table of neighbourhood codes. Only boundary pixels can be
+    # removed, and a pixel's decision only changes with its neighbourhood, so each sub-iteration tests
+    # the pixels next to the last removals rather than the whole image.
+    image = np.pad((mask > 0).astype(np.uint8), 1)
+    pixels = image.ravel()
+    width = image.shape[1]
+    offsets = np.array([-width, 1 - width, 1, width + 1, width, width - 1, -1, -width - 1])
+    bits = np.arange(8, dtype=np.uint8)
+    candidates = np.flatnonzero(pixels)
+    candidates = candidates[(pixels[candidates[:, None] + offsets] == 0).any(axis=1)]
+    while True:
+        changed = False
+        for table in REMOVAL_TABLES:
+            codes = (pixels[candidates[:, None] + offsets] << bits).sum(axis=1)
+            remove = table[codes] == 1
+            if remove.any():
+                removed = candidates[remove]
+                pixels[removed] = 0
+                touched = (removed[:, None] + offsets).ravel()
+                candidates = np.union1d(candidates[~remove], touched[pixels[touched] == 1])
+                changed = True
+        if not changed:
+            return image[1:-1, 1:-1]
+
+
+def skeleton_paths(skeleton):
+    # Split the skeleton at its junctions into simple paths of (x, y) points. Paths that ended at a
+    # junction are extended to its centre, so branches stay connected.
+    junctions = (skeleton == 1) & (transitions(neighbours(np.pad(skeleton, 1))) >= 3)
+    junction_zones = cv2.dilate(junctions.astype(np.uint8), KERNEL)
+    branches = skeleton & (1 - junction_zones)
+    _, zone_labels, _, zone_centres = cv2.connectedComponentsWithStats(cv2.dilate(junction_zones, KERNEL))
+
+    endpoints = (branches == 1) & (transitions(neighbours(np.pad(branches, 1))) <= 1)
+    contours, _ = cv2.findContours(branches, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    paths = []
+    for contour in contours:
+        contour = contour[:, 0]
+        ends = np.flatnonzero(endpoints[contour[:, 1], contour[:, 0]])
+        if not len(ends):
+            # Closed loop
+            paths.append((contour, True))
+            continue
+        # The contour of a one pixel wide path runs from one end to the other and back
+        path = np.roll(contour, -ends[0], axis=0)[:len(contour) // 2 + 1]
+        start_zone, end_zone = zone_labels[path[0, 1], path[0, 0]], zone_labels[path[-1, 1], path[-1, 0]]
+        centres = np.round(zone_centres).astype(path.dtype)
+        if start_zone:
+            path = np.concatenate([centres[start_zone:start_zone + 1], path])
+        if end_zone:
+            path = np.concatenate([path, centres[end_zone:end_zone + 1]])
+        paths.append((path, False))
+    return paths
+
+
+def vectorize_mask(mask, epsilon=2.0, min_length=20):
+    # Rail line segments [x1, y1, x2, y2] of a binary mask: skeleton paths simplified with
+    # Douglas-Peucker, dropping paths shorter than min_length pixels
+    ys, xs = np.nonzero(mask)
+    if not len(ys):
+        return []
+    # Thin only the part of the tile that holds the mask, with a one pixel border
+    top, left = max(ys.min() - 1, 0), max(xs.min() - 1, 0)
+    crop = mask[top:ys.max() + 2, left:xs.max() + 2]
+    segments = []
+    for path, closed in skeleton_paths(thin(crop)):
+        if cv2.arcLength(path.reshape(-1, 1, 2), closed) < min_length:
+            continue
+        points = cv2.approxPolyDP(path.reshape(-1, 1, 2), epsilon, closed)[:, 0] + (left, top)
+        if closed:
+            points = np.concatenate([points, points[:1]])
+        segments.extend([int(value) for value in np.concatenate([start, end])]
+                        for start, end in zip(points[:-1], points[1:]))
+    return segments
+
+
+def rail_lines(segments):
+    return [{"id": index, "type": "rail", "color": LINE_COLOR, "coordinates": segment}
+            for index, segment in enumerate(segments)]
+
+
+def vectorize_batch(image_paths, epsilon=2.0, min_length=20, overwrite=False):
+    # Rail lines files are only written where none exist, unless overwrite is set. Tiles where no rail
+    # was found get no file, so they stay unlabelled and are not used as empty training masks.
+    written = 0
+    for image_path in image_paths:
+        lines_path = rail_lines_path(image_path)
+        if not overwrite and os.path.exists(lines_path):
+            continue
+        mask = cv2.imread(prediction_path(image_path), cv2.IMREAD_GRAYSCALE) > 127
+        segments = vectorize_mask(mask, epsilon, min_length)
+        if not segments:
+            continue
+        write_json_atomic(lines_path, rail_lines(segments))
+        written += 1
+    return len(image_paths), written
+
+
+def vectorize_predictions(image_paths, epsilon=2.0, min_length=20, workers=1, overwrite=False, batch_size=64,
+                          progress=None):
+    # Tiles without a predicted mask are skipped
+    image_paths = [image_path for image_path in image_paths if os.path.exists(prediction_path(image_path))]
+    batches = [image_paths[start:start + batch_size]
+               for start in range(0, len(image_paths), batch_size)]
+
+    done, written = 0, 0
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(vectorize_batch, batch, epsilon, min_length, overwrite) for batch in batches]
+            for future in as_completed(futures):
+                batch_done, batch_written = future.result()
+                done, written = done + batch_done, written + batch_written
+                if progress is not None:
+                    progress(done, len(image_paths), written)
+    else:
+        for batch in batches:
+            batch_done, batch_written = vectorize_batch(
+                batch, epsilon, min_length, overwrite)
+            done, written = done + batch_done, written + batch_written
+            if progress is not None:
+                progress(done, len(image_paths), written)
+    return written
+
+
+def print_progress(done, total, written):
+    print(f'Checked {done}/{total} predictions, wrote {written} rail lines files')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert predicted masks into rail lines files the labelling tool can edit')
+    parser.add_argument('root', nargs='?', default='data')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--epsilon', type=float, default=2.0,
+                        help='largest distance in pixels between a simplified line and the skeleton')
+    parser.add_argument('--min-length', type=float, default=20,
+                        help='drop skeleton paths shorter than this many pixels')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='replace existing rail lines files, including manual annotations')
+    args = parser.parse_args()
+
+    image_paths = cached_image_paths(args.root)
+    if image_paths is None:
+        image_paths = list(scan_image_paths(args.root))
+    vectorize_predictions(image_paths, args.epsilon, args.min_length,
+                          args.workers, args.overwrite, progress=print_progress)
+
+
+if __name__ == '__main__':
+    main()